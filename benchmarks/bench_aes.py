@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+#Compares the symetric stage of Giltzarrapo : one aes call per block against one aes call per run of blocks
+#Usage : python3 benchmarks/bench_aes.py [blocks] [repetitions]
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'))
+
+from Crypto.Cipher import AES
+from giltzarrapo import Giltzarrapo, BlockStore
+
+def per_block(blocks, selected_block, key_block, cipher):
+    #Symetric stage before the bulk implementation
+    return [key_block if (i == selected_block) else cipher(b) for i,b in enumerate(blocks)]
+
+def bulk(blocks, selected_block, key_block, cipher):
+    store = BlockStore(len(key_block), b''.join(blocks))
+    store.cipher(cipher, selected_block, key_block, Giltzarrapo.RUN)
+    return store
+
+def measure(function, blocks, selected_block, key_block, cipher, repetitions):
+    best = None
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        function(blocks, selected_block, key_block, cipher)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best: best = elapsed
+    return best
+
+if __name__ == '__main__':
+    nblocks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    blocks = [os.urandom(512) for _ in range(nblocks)]
+    selected_block = nblocks // 2
+    key_block = os.urandom(512)
+    encryptor = AES.new(os.urandom(32))
+
+    print('{} blocks of 512 bytes, best of {}'.format(nblocks, repetitions))
+    for name, cipher in [('encrypt', encryptor.encrypt), ('decrypt', encryptor.decrypt)]:
+        old = measure(per_block, blocks, selected_block, key_block, cipher, repetitions)
+        new = measure(bulk, blocks, selected_block, key_block, cipher, repetitions)
+        print('  {:<8} per block : {:>12.0f} blocks/s'.format(name, nblocks / old))
+        print('  {:<8} bulk      : {:>12.0f} blocks/s  (x{:.2f})'.format(name, nblocks / new, old / new))
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+#Benchmarks Giltzarrapo and PasswdManager operations at several database sizes. Reports the best time and the peak memory of every operation
+#Usage : python3 benchmarks/bench_suite.py [--rows=10,1000,10000,100000] [--repeat=3] [--only=case,...] [--save=file.json] [--compare=file.json] [--threshold=0.1]
+#benchmarks/baseline.json was saved with --rows=10,1000,10000 --repeat=3, compare against it with --compare=benchmarks/baseline.json
+#The rsa keys are fixtures, generated once with Giltzarrapo.generateRSApair(PASSPHRASE, dir = FIXTURES, name = 'bench_rsa'),
+#so no run pays for generating keys. Parsed keys stay cached between runs, as they do in a session.
+#The peak memory is the one traced by tracemalloc in a separate run, so it does not slow down the timed runs.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'))
+
+from giltzarrapo import Giltzarrapo, optional_numpy
+from pmanager import PasswdManager
+from rmanager import RecordManager
+from utils import popoption
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+PRIVKEY = os.path.join(FIXTURES, 'bench_rsa')
+PUBKEY = os.path.join(FIXTURES, 'bench_rsa.pub')
+PASSPHRASE = 'passranoid-bench'
+PASSWD = 'bench'
+
+def makerows(count):
+    #Same rows on every run
+    rng = random.Random(count)
+    return [['svc{}'.format(i % 1000), 'user{}@example.com'.format(i), ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(20))] for i in range(count)]
+
+def encrypted(payload, dbfile, fast = True):
+    g = Giltzarrapo()
+    g.blocks.extend(payload)
+    g.status = 'plain'
+    g.encrypt(PASSWD, PUBKEY, fast = fast).save(dbfile)
+    return open(dbfile, 'rb').read()
+
+def prepare(count, directory):
+    """Write every file used by the cases of a database size"""
+    db = {'dir' : directory, 'rows' : count}
+    header = ['passranoid_database:v2', 'passranoid_interface:v1.2', 'passranoid_config:v1']
+    payload = RecordManager.build(header, makerows(count))
+
+    db['plainfile'] = os.path.join(directory, 'plain')
+    with open(db['plainfile'], 'wb') as f: f.write(payload)
+
+    db['conf'] = {'dbfile' : os.path.join(directory, 'db'), 'privkey' : PRIVKEY, 'pubkey' : PUBKEY}
+    db['pristine'] = encrypted(payload, db['conf']['dbfile'])
+    db['empty'] = encrypted(RecordManager.build(header, []), os.path.join(directory, 'empty'))
+    db['slowfile'] = os.path.join(directory, 'slow')
+    encrypted(payload, db['slowfile'], fast = False)
+
+    db['tsvfile'] = os.path.join(directory, 'rows.tsv')
+    PasswdManager.exportdb(db['conf'], db['tsvfile'], PASSWD, PASSPHRASE)
+    db['exportfile'] = os.path.join(directory, 'export.tsv')
+    return db
+
+def restore(db, content = 'pristine'):
+    with open(db['conf']['dbfile'], 'wb') as f: f.write(db[content])
+
+def nolocator(g):
+    #A v1 file, whose symetric block is searched in every block
+    del g.info['locator']
+    g.info['version'] = 1
+    return g
+
+#name : (setup, run). setup is not timed and returns the argument of run
+CASES = [
+    ('readPlain', (lambda db: None, lambda db, _: Giltzarrapo().readPlain(db['plainfile']))),
+    ('readEncrypted', (lambda db: None, lambda db, _: Giltzarrapo().readEncrypted(db['conf']['dbfile']))),
+    ('encrypt', (lambda db: Giltzarrapo().readPlain(db['plainfile']), lambda db, g: g.encrypt(PASSWD, PUBKEY))),
+    ('decrypt', (lambda db: Giltzarrapo().readEncrypted(db['conf']['dbfile']), lambda db, g: g.decrypt(PASSWD, PRIVKEY, PASSPHRASE))),
+    ('findBlock fast', (lambda db: Giltzarrapo().readEncrypted(db['conf']['dbfile']), lambda db, g: g.findBlock(PASSWD, PRIVKEY, PASSPHRASE))),
+    ('findBlock non-fast', (lambda db: Giltzarrapo().readEncrypted(db['slowfile']), lambda db, g: g.findBlock(PASSWD, PRIVKEY, PASSPHRASE))),
+    ('findBlock no locator', (lambda db: nolocator(Giltzarrapo().readEncrypted(db['slowfile'])), lambda db, g: g.findBlock(PASSWD, PRIVKEY, PASSPHRASE))),
+    ('selectBlock', (lambda db: Giltzarrapo().readPlain(db['plainfile']), lambda db, g: g.selectBlock())),
+    ('insert', (restore, lambda db, _: PasswdManager.insert(db['conf'], 'bench', 'user', 'secret', PASSWD, PASSPHRASE))),
+    ('select', (lambda db: None, lambda db, _: PasswdManager.select(db['conf'], 'svc7', PASSWD, PASSPHRASE))),
+    ('remove', (restore, lambda db, _: PasswdManager.remove(db['conf'], 0, PASSWD, PASSPHRASE))),
+    ('importdb', (lambda db: restore(db, 'empty'), lambda db, _: PasswdManager.importdb(db['conf'], db['tsvfile'], PASSWD, PASSPHRASE))),
+    ('exportdb', (lambda db: None, lambda db, _: PasswdManager.exportdb(db['conf'], db['exportfile'], PASSWD, PASSPHRASE))),
+]
+
+def measure(db, setup, run, repeat):
+    best = None
+    for _ in range(repeat):
+        arg = setup(db)
+        start = time.perf_counter()
+        run(db, arg)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best: best = elapsed
+
+    arg = setup(db)
+    tracemalloc.start()
+    try :
+        run(db, arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally : tracemalloc.stop()
+    return {'seconds' : best, 'peak' : peak}
+
+def compare(results, baseline, threshold):
+    """Print the change against the baseline of every measured case. Returns the cases slower than the threshold"""
+    regressions = []
+    print('\nCompared with the baseline')
+    for key, result in results.items():
+        if key not in baseline: continue
+        ratio = result['seconds'] / max(baseline[key]['seconds'], 1e-9)
+        memory = result['peak'] / max(baseline[key]['peak'], 1)
+        mark = ''
+        if ratio > 1 + threshold:
+            regressions.append(key)
+            mark = '  SLOWER'
+        print('  {:<32} time x{:<6.2f} memory x{:<6.2f}{}'.format(key, ratio, memory, mark))
+    return regressions
+
+if __name__ == '__main__':
+    counts = [int(c) for c in popoption('--rows', '10,1000,10000,100000').split(',')]
+    repeat = int(popoption('--repeat', 3))
+    only = popoption('--only', None)
+    savefile = popoption('--save', None)
+    comparefile = popoption('--compare', None)
+    threshold = float(popoption('--threshold', 0.1))
+    cases = [(name, case) for name, case in CASES if only is None or name in only.split(',')]
+
+    print('python {} on {} cpus, numpy {}. Best of {}'.format(platform.python_version(), os.cpu_count(), 'yes' if optional_numpy() is not None else 'no', repeat))
+    results = {}
+    for count in counts:
+        directory = tempfile.mkdtemp(prefix = 'passranoid-bench-')
+        try :
+            db = prepare(count, directory)
+            print('\n{} rows, {} bytes encrypted'.format(count, len(db['pristine'])))
+            for name, (setup, run) in cases:
+                result = measure(db, setup, run, repeat)
+                results['{}@{}'.format(name, count)] = result
+                print('  {:<24} {:>10.2f} ms {:>10.1f} KiB peak'.format(name, result['seconds'] * 1000, result['peak'] / 1024))
+        finally : shutil.rmtree(directory)
+
+    if savefile is not None:
+        meta = {'python' : platform.python_version(), 'machine' : platform.machine(), 'cpus' : os.cpu_count(), 'numpy' : optional_numpy() is not None, 'repeat' : repeat, 'date' : time.strftime('%Y-%m-%d %H:%M:%S')}
+        with open(savefile, 'w') as f: json.dump({'meta' : meta, 'results' : results}, f, indent = 2, sort_keys = True)
+        print('\nResults saved at {}'.format(savefile))
+
+    if comparefile is not None:
+        with open(comparefile, 'r') as f: baseline = json.load(f)['results']
+        if len(compare(results, baseline, threshold)) > 0: sys.exit(1)
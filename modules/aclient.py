@@ -0,0 +1,48 @@
+import os
+import json
+import stat
+import socket
+
+class AgentClient:
+    """Client side of the agent protocol. Kept apart from the agent so clients do not import the crypto stack"""
+
+    @staticmethod
+    def default_socket():
+        runtime = os.environ.get('XDG_RUNTIME_DIR')
+        if runtime is None or not os.path.isdir(runtime): runtime = '/tmp/passranoid-{}'.format(os.getuid())
+        return '{}/passranoid-agent.sock'.format(runtime)
+
+    @staticmethod
+    def check_directory(socket_path):
+        """
+        Refuse a socket whose directory is not a real directory owned by this user and private to it,
+        as anyone able to place the socket would receive the passwords sent to the agent
+        """
+        directory = os.path.dirname(os.path.abspath(socket_path))
+        try : st = os.lstat(directory)
+        except FileNotFoundError: return
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+            raise ValueError('The agent directory {} must be a directory owned by you with mode 700'.format(directory))
+
+    @staticmethod
+    def listening(socket_path):
+        AgentClient.check_directory(socket_path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try : sock.connect(socket_path)
+            except (ConnectionError, FileNotFoundError): return False
+        return True
+
+    @staticmethod
+    def request(socket_path, command, **kwargs):
+        """Send a request to the agent and return its result. Errors reported by the agent are raised as ValueError"""
+        AgentClient.check_directory(socket_path)
+        kwargs['command'] = command
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(kwargs).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as response: line = response.readline()
+
+        if not line: raise ValueError('The agent closed the connection')
+        response = json.loads(line.decode('utf-8'))
+        if not response['ok']: raise ValueError(response['error'])
+        return response['result']
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import socket
+import struct
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pmanager import PasswdManager
+from smanager import SessionManager
+from aclient import AgentClient
+from confmanager import ConfigManager
+
+class AgentManager:
+    """
+    Keeps unlocked databases in memory and serves them to local clients over a unix socket.
+    Clients talk to it through AgentClient.
+
+    The protocol is a json object per line in both directions. A request names the command
+    and its arguments and the response is {"ok": true, "result": ...} or {"ok": false, "error": ...} :
+        status : names of the unlocked databases
+        unlock : db, passwd, passphrase
+        lock : db
+        select : db, service
+        list : db
+        insert : db, service, user, password (empty to generate it). Returns the password
+        stop : lock every database and exit
+
+    Requests run in worker threads. A request waits at most lock_timeout seconds for a database
+    used by another client. A database unused for lifetime seconds is locked again, 0 to never lock it.
+    """
+
+    PEERCRED = struct.Struct('3i')
+
+    def __init__(self, configfile, socket_path = None, lifetime = 0, lock_timeout = 5, flush = 'immediate', session_timeout = 300, workers = 4):
+        self.configfile = configfile
+        self.config = ConfigManager(configfile)
+        self.socket_path = socket_path if socket_path is not None else AgentClient.default_socket()
+        self.lifetime = lifetime
+        self.lock_timeout = lock_timeout
+        self.flush = SessionManager.parse_policy(flush)
+        self.session_timeout = session_timeout
+        self.workers = workers
+
+        self.sessions = {}
+        self.last_use = {}
+        self.guard = threading.Lock()
+        self.executor = None
+        self.stopping = None
+
+    def getconf(self, dbname):
+        #The agent outlives changes to the config, which are picked up on the next unlock
+        config = self.config.load(check = True)
+        if dbname not in config: raise ValueError('The database {} does not exists'.format(dbname))
+        return config[dbname]
+
+    def unlock(self, dbname, passwd, passphrase):
+        conf = self.getconf(dbname)
+        session = SessionManager(conf, passwd, passphrase, flush = self.flush, timeout = self.session_timeout)
+        if not PasswdManager.verifyauth(conf, passwd, passphrase, session = session):
+            session.close()
+            raise ValueError('Wrong password or/and passphrase')
+
+        with self.guard:
+            previous = self.sessions.get(dbname)
+            self.sessions[dbname] = session
+            self.last_use[dbname] = time.time()
+        if previous is not None: previous.close()
+
+    def lock(self, dbname):
+        with self.guard:
+            session = self.sessions.pop(dbname, None)
+            self.last_use.pop(dbname, None)
+        if session is None: raise ValueError('The database {} is not unlocked'.format(dbname))
+        session.close()
+
+    def getsession(self, dbname):
+        with self.guard:
+            if dbname not in self.sessions: raise ValueError('The database {} is locked'.format(dbname))
+            self.last_use[dbname] = time.time()
+            return self.sessions[dbname]
+
+    def run(self, request):
+        """Runs a request and returns its result. Errors are raised as ValueError"""
+        command = request.get('command')
+        if command == 'status':
+            with self.guard: return sorted(self.sessions)
+        if command == 'unlock': return self.unlock(request['db'], request['passwd'], request.get('passphrase', ''))
+        if command == 'lock': return self.lock(request['db'])
+        if command not in ['select', 'list', 'insert']: raise ValueError('Unknown command {}'.format(command))
+
+        session = self.getsession(request['db'])
+        if not session.lock.acquire(timeout = self.lock_timeout): raise ValueError('The database {} is busy'.format(request['db']))
+        try :
+            if command == 'select': return PasswdManager.select(session.conf, request['service'], session.passwd, session.passphrase, session = session)
+            if command == 'list': return PasswdManager.list(session.conf, session.passwd, session.passphrase, session = session)
+
+            spasswd = request.get('password', '')
+            if spasswd == '': spasswd = PasswdManager.passgen()
+            PasswdManager.insert(session.conf, request['service'], request['user'], spasswd, session.passwd, session.passphrase, session = session)
+            return spasswd
+        finally : session.lock.release()
+
+    def expire(self):
+        """Lock the databases unused for more than lifetime seconds"""
+        if not self.lifetime: return
+        now = time.time()
+        with self.guard: expired = [db for db, last in self.last_use.items() if now >= last + self.lifetime]
+        for dbname in expired:
+            try : self.lock(dbname)
+            except ValueError: pass
+
+    def close(self):
+        with self.guard: dbnames = list(self.sessions)
+        for dbname in dbnames:
+            try : self.lock(dbname)
+            except ValueError: pass
+
+    @staticmethod
+    def same_user(writer):
+        #Only the owner of the agent can talk to it, even if the socket permissions are changed
+        sock = writer.get_extra_info('socket')
+        if sock is None or not hasattr(socket, 'SO_PEERCRED'): return True
+        pid, uid, gid = AgentManager.PEERCRED.unpack(sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, AgentManager.PEERCRED.size))
+        return uid == os.getuid()
+
+    async def client(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        try :
+            if not AgentManager.same_user(writer): return
+            while True:
+                try : line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):
+                    #Past the stream limit the rest of the request can not be told apart from the next one, so the connection is closed
+                    writer.write(json.dumps({'ok' : False, 'error' : 'Request too long'}).encode('utf-8') + b'\n')
+                    await writer.drain()
+                    break
+                if not line: break
+
+                try :
+                    request = json.loads(line.decode('utf-8'))
+                    if not isinstance(request, dict): raise ValueError('The request must be a json object')
+                    if request.get('command') == 'stop':
+                        self.stopping.set()
+                        response = {'ok' : True, 'result' : None}
+                    else : response = {'ok' : True, 'result' : await loop.run_in_executor(self.executor, self.run, request)}
+                except KeyError as e: response = {'ok' : False, 'error' : 'Missing argument {}'.format(e)}
+                except Exception as e: response = {'ok' : False, 'error' : str(e)}
+
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError): pass
+        finally : writer.close()
+
+    async def expirer(self):
+        loop = asyncio.get_event_loop()
+        while not self.stopping.is_set():
+            await loop.run_in_executor(self.executor, self.expire)
+            try : await asyncio.wait_for(self.stopping.wait(), timeout = 1)
+            except asyncio.TimeoutError: pass
+
+    async def main(self):
+        self.stopping = asyncio.Event()
+        directory = os.path.dirname(os.path.abspath(self.socket_path))
+        if not os.path.lexists(directory):
+            os.makedirs(directory, 0o700)
+            os.chmod(directory, 0o700)
+        AgentClient.check_directory(self.socket_path)
+        if os.path.exists(self.socket_path):
+            if AgentClient.listening(self.socket_path): raise ValueError('An agent is already listening at {}'.format(self.socket_path))
+            os.remove(self.socket_path)
+
+        #Create the socket already private to the owner
+        umask = os.umask(0o177)
+        try : server = await asyncio.start_unix_server(self.client, path = self.socket_path)
+        finally : os.umask(umask)
+
+        try : await self.expirer()
+        finally :
+            server.close()
+            await server.wait_closed()
+
+            #Drop the clients still connected
+            clients = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for t in clients: t.cancel()
+            await asyncio.gather(*clients, return_exceptions = True)
+            if os.path.exists(self.socket_path): os.remove(self.socket_path)
+
+    def serve(self):
+        self.executor = ThreadPoolExecutor(max_workers = self.workers)
+        loop = asyncio.new_event_loop()
+        try : loop.run_until_complete(self.main())
+        finally :
+            self.executor.shutdown(wait = True)
+            self.close()
+            loop.close()
@@ -1,5 +1,4 @@
 import sys
-import yaml
 import readline
 from os import R_OK, W_OK
 from os import popen, listdir, access, remove
@@ -7,17 +6,34 @@ from os.path import isdir, isfile
 from getpass import getpass
 from printer import cprint, cprepare
 from imanager import InputManager
+from smanager import SessionManager
+from kmanager import KeyManager
+from confmanager import ConfigManager
+from profiler import Profiler
 
 class CommandManager:
-    def __init__(self, configfile, databases_path, keys_path):
+    #Number of errors reported, so batch mode can stop at the first failing command
+    errors = 0
+
+    #Commands that write the database or change the one in use, which can not run inside a transaction
+    nontransactional = ['use', 'refresh', 'changedbpass', 'changedbkey']
+
+    def __init__(self, configfile, databases_path, keys_path, flush = 'immediate', session_timeout = 300, keypool = 0):
         self.configfile = configfile
-        if not isfile(self.configfile): self.config = {}
-        else : self.config = yaml.safe_load(open(self.configfile, 'r'))
+        self.config = ConfigManager(configfile)
 
         self.databases_path = databases_path
         self.keys_path = keys_path
         self.using = None
         self.auth = None
+        self.session = None
+        self.locked_session = None
+        self.flush = SessionManager.parse_policy(flush)
+        self.session_timeout = session_timeout
+        self.keypool = None
+        if keypool > 0:
+            self.keypool = KeyManager(keys_path, size = keypool)
+            self.keypool.fill()
 
         self.im = InputManager(self.config)
 
@@ -28,36 +44,39 @@ class CommandManager:
         return True
 
     def add_db(self, dbname, newconf):
-        if dbname in self.config:
-            CommandManager.error('The database already exists')
+        #Only the new entry is written, over the config on disk
+        try : self.config.add(dbname, newconf)
+        except ValueError as e:
+            CommandManager.error(str(e))
             return False
-
-        self.config[dbname] = newconf
-
-        if not self.save_config():
-            self.remove_db(dbname)
+        except Exception:
+            CommandManager.error('Error writing to the config file {}'.format(self.configfile))
             return False
         return True
 
     def remove_db(self, dbname):
-        if not dbname in self.config:
-            CommandManager.error('The database does not exists')
+        try : rconf = self.config.remove(dbname)
+        except ValueError as e:
+            CommandManager.error(str(e))
+            return False
+        except Exception:
+            CommandManager.error('Error writing to the config file {}'.format(self.configfile))
             return False
-
-        rconf = self.config.pop(dbname)
 
         if isfile(rconf['dbfile']):
-            try : os.remove(rconf['dbfile'])
+            try : remove(rconf['dbfile'])
             except :
                 CommandManager.error('Can not remove db {}'.format(rconf['dbfile']))
                 return False
         return True
 
-    def save_config(self):
-        try : yaml.dump(self.config, open(self.configfile, 'w'), default_flow_style=False, allow_unicode=True)
-        except :
-            CommandManager.error('Error writing to the config file {}'.format(self.configfile))
-            return False
+    def check_files(self, conf, recheck = False):
+        #Each file is looked up once per process. A failed operation rechecks them, as one may have been removed
+        for filetype, file in conf.items():
+            if recheck: self.config.forget(file)
+            if not self.config.exists(file):
+                CommandManager.error('{} {} not found'.format(filetype.capitalize(), file))
+                return False
         return True
 
     def get_db(self, dbname):
@@ -66,11 +85,7 @@ class CommandManager:
             return [False, {}]
 
         conf = self.config[dbname]
-        for filetype, file in conf.items():
-            if not isfile(file):
-                CommandManager.error('{} {} not found'.format(filetype.capitalize(), file))
-                return [False, {}]
-
+        if not self.check_files(conf): return [False, {}]
         return [True, conf]
 
     def get_using_db(self):
@@ -78,11 +93,7 @@ class CommandManager:
             CommandManager.error('No database in use')
             return [False, {}]
 
-        for filetype, file in self.using.items():
-            if not isfile(file):
-                CommandManager.error('{} {} not found'.format(filetype.capitalize(), file))
-                return [False, {}]
-
+        if not self.check_files(self.using): return [False, {}]
         return [True, self.using]
 
     def set_auth(self, conf, passwd, passphrase):
@@ -93,9 +104,57 @@ class CommandManager:
         if CommandManager.is_empty(passwd, 'Password can not be empty'): return False
         self.auth = {'passwd' : passwd, 'passphrase' : passphrase}
 
+    def new_session(self, conf, passwd, passphrase):
+        return SessionManager(conf, passwd, passphrase, flush = self.flush, timeout = self.session_timeout)
+
+    def set_session(self, session):
+        if session is not self.session: self.close_session()
+        self.session = session
+        self.im.session = session
+
+    def close_session(self):
+        if self.session is None: return True
+
+        try : self.session.close()
+        except Exception as e:
+            CommandManager.error('Can not save the database in use : {}'.format(e))
+            return False
+        finally :
+            self.session = None
+            self.im.session = None
+        return True
+
+    def lock_session(self):
+        #Keep the idle timer away from the session while a command runs
+        self.locked_session = self.session
+        if self.locked_session is not None: self.locked_session.lock.acquire()
+
+    def unlock_session(self):
+        if self.locked_session is not None: self.locked_session.lock.release()
+        self.locked_session = None
+
+    def in_transaction(self):
+        return self.session is not None and self.session.in_transaction()
+
+    def transaction(self, action):
+        """Runs begin, commit or rollback on the session of the database in use"""
+        if self.session is None:
+            CommandManager.error('No database in use')
+            return False
+
+        try : getattr(self.session, action)()
+        except ValueError as e:
+            CommandManager.error(str(e))
+            return False
+        except Exception as e:
+            CommandManager.error('Can not save the database in use : {}'.format(e))
+            return False
+        return True
+
 
     @staticmethod
     def error(text):
+        CommandManager.errors += 1
         cprint(text, color = 'red')
 
     @staticmethod
@@ -227,20 +286,27 @@ class CommandManager:
             try : args.remove('')
             except ValueError: break
 
+        if command in CommandManager.nontransactional and self.in_transaction():
+            CommandManager.error('Commit or rollback the open transaction first')
+            return False
+
         try:
-            if command == 'create': command_args = self._create(args)
-            elif command == 'use' : command_args = self._use(args)
-            elif command == 'insert' : command_args = self._insert(args)
-            elif command == 'list' : command_args = self._list()
-            elif command == 'select' : command_args = self._select(args)
-            elif command == 'remove' : command_args = self._remove(args)
-            elif command == 'version' : command_args = self._version()
-            elif command == 'passgen' : command_args = self._passgen(args)
-            elif command == 'changedbpass' : command_args = self._changedbpass()
-            elif command == 'changedbkey' : command_args = self._changedbkey()
-            elif command == 'export' : command_args = self._exportdb(args)
-            elif command == 'import' : command_args = self._importdb(args)
-            else: raise ValueError('Unknown command')
+            with Profiler.span('arguments'):
+                if command == 'create': command_args = self._create(args)
+                elif command == 'use' : command_args = self._use(args)
+                elif command == 'insert' : command_args = self._insert(args)
+                elif command == 'list' : command_args = self._list()
+                elif command == 'select' : command_args = self._select(args)
+                elif command == 'selectall' : command_args = self._selectall(args)
+                elif command == 'remove' : command_args = self._remove(args)
+                elif command == 'version' : command_args = self._version()
+                elif command == 'refresh' : command_args = self._refresh()
+                elif command == 'passgen' : command_args = self._passgen(args)
+                elif command == 'changedbpass' : command_args = self._changedbpass()
+                elif command == 'changedbkey' : command_args = self._changedbkey()
+                elif command == 'export' : command_args = self._exportdb(args)
+                elif command == 'import' : command_args = self._importdb(args)
+                else: raise ValueError('Unknown command')
         except (KeyboardInterrupt, EOFError) as e: raise e
         finally : self.im.clear_buffer(autocompletion = True)
 
@@ -294,16 +360,21 @@ class CommandManager:
         success, conf = self.get_using_db()
         if not success : return False
 
+        self.im.set_buffer(buffer = 'insert ', prompt = 'service: ')
         if len(args) >= 1: service = args[0]
         else : service = self.im.input('service: ', history = False)
         if CommandManager.is_empty(service, 'The service can not be empty'): return False
 
+        self.im.set_buffer(buffer = 'insert {} '.format(service), prompt = 'user: ')
         if len(args) >= 2: user = args[1]
         else : user = self.im.input('user: ', history = False)
         if CommandManager.is_empty(user, 'The user can not be empty'): return False
+        self.im.clear_buffer()
 
-        success, spasswd = CommandManager.getservicepasswd(doublecheck = True)
-        if not success : return False
+        if len(args) >= 3: spasswd = args[2]
+        else :
+            success, spasswd = CommandManager.getservicepasswd(doublecheck = True)
+            if not success : return False
 
         success, passwd = CommandManager.getpasswd(auth = self.auth)
         if not success : return False
@@ -327,9 +398,11 @@ class CommandManager:
         success, conf = self.get_using_db()
         if not success : return False
 
+        self.im.set_buffer(buffer = 'select ', prompt = 'service: ')
         if len(args) >= 1: service = args[0]
         else: service = self.im.input('service: ', history = False)
         if CommandManager.is_empty(service, 'The service can not be empty'): return False
+        self.im.clear_buffer()
 
         success, passwd = CommandManager.getpasswd(auth = self.auth)
         if not success : return False
@@ -338,16 +411,66 @@ class CommandManager:
 
         return [conf, service, passwd, passphrase]
 
+    def _selectall(self, args):
+        if len(self.config) == 0:
+            CommandManager.error('There are no databases')
+            return False
+
+        if len(args) >= 1: service = args[0]
+        else: service = self.im.input('service: ', history = False)
+        if CommandManager.is_empty(service, 'The service can not be empty'): return False
+
+        #Every database asks for its own credentials, except the one in use
+        databases, previous = {}, None
+        for dbname in self.config:
+            #A database that can not be used is reported and skipped, the others are still searched
+            success, conf = self.get_db(dbname)
+            if not success :
+                CommandManager.error('Skipping {}'.format(dbname))
+                continue
+
+            if conf == self.using and self.auth is not None:
+                databases[dbname] = [conf, self.auth['passwd'], self.auth['passphrase']]
+                continue
+
+            cprint(dbname, color = 'blue')
+            passwd = getpass('Password{}: '.format('' if previous is None else ' (Empty to reuse the previous credentials)'))
+            if passwd == '' and previous is not None: databases[dbname] = [conf] + previous
+            else :
+                if CommandManager.is_empty(passwd, 'Password can not be empty'): return False
+                success, passphrase = CommandManager.getpassphrase()
+                if not success : return False
+                previous = [passwd, passphrase]
+                databases[dbname] = [conf] + previous
+
+        if len(databases) == 0:
+            CommandManager.error('There are no usable databases')
+            return False
+
+        return [databases, service]
+
     def _remove(self, args):
         success, conf = self.get_using_db()
         if not success : return False
 
-        if len(args) >= 1: index = args[0]
-        else : index = self.im.input('Row index (Use * for all): ', history = False)
-        if CommandManager.is_empty(index, 'The index can not be empty'): return False
-        if index != '*':
-            success, index = CommandManager.cast_to_int(index, 'Index must be either * or an integer')
-            if not success : return False
+        if len(args) >= 1: selectors = args
+        else : selectors = [self.im.input('Row indexes or filters (Use * for all): ', history = False)]
+        selectors = [s for a in selectors for s in a.replace(',', ' ').split()]
+        if CommandManager.is_empty(' '.join(selectors), 'The index can not be empty'): return False
+
+        if selectors == ['*']: index = '*'
+        elif all(['=' in s for s in selectors]):
+            index = dict([s.split('=', 1) for s in selectors])
+            if any([k not in ['service', 'user'] or v == '' for k,v in index.items()]):
+                CommandManager.error('Filters must be service=<name> or user=<name>')
+                return False
+        else :
+            index = []
+            for s in selectors:
+                success, i = CommandManager.cast_to_int(s, 'Indexes must be either * or integers')
+                if not success : return False
+                index.append(i)
+            if len(index) == 1: index = index[0]
 
         success, passwd = CommandManager.getpasswd(auth = self.auth)
         if not success : return False
@@ -367,6 +490,17 @@ class CommandManager:
 
         return [conf, passwd, passphrase]
 
+    def _refresh(self):
+        success, conf = self.get_using_db()
+        if not success : return False
+
+        success, passwd = CommandManager.getpasswd(auth = self.auth)
+        if not success : return False
+        success, passphrase = CommandManager.getpassphrase(auth = self.auth)
+        if not success : return False
+
+        return [conf, passwd, passphrase]
+
     def _passgen(self, args):
         if len(args) >= 1: length = args[0]
         else : length = self.im.input('Password length: ', history = False)
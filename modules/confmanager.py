@@ -0,0 +1,119 @@
+import os
+import marshal
+import tempfile
+from lmanager import LockManager
+from profiler import Profiler
+
+class ConfigManager:
+    """
+    The databases of the config file, by name.
+
+    The yaml file is only parsed when it changes: the parsed config is kept in <configfile>.cache,
+    which is valid while the config file keeps the inode, size and modification time it was built from.
+    The config is loaded on first use. Changes are written one database at a time, holding the lock of
+    the config file and starting from the config on disk, so processes creating databases at once do
+    not lose each other's entries.
+
+    The files of a database are checked once per process. A file removed later is reported when the
+    operation using it fails, which forgets it so the next check looks again.
+    """
+
+    CACHE_VERSION = 1
+
+    def __init__(self, configfile):
+        self.configfile = configfile
+        self.cachefile = '{}.cache'.format(configfile)
+        self.config = None
+        self.stamp = None
+        self.found = set()
+
+    def load(self, check = False):
+        """Returns the config. With check, it is loaded again if the file changed since it was read"""
+        if self.config is not None and not check: return self.config
+
+        stamp = LockManager.stamp(self.configfile)
+        if self.config is None or stamp != self.stamp:
+            with Profiler.span('config'): self.config = self.read(stamp)
+            self.stamp = stamp
+        return self.config
+
+    def read(self, stamp):
+        if stamp is None: return {}
+
+        try :
+            with open(self.cachefile, 'rb') as f: cached = marshal.load(f)
+            if cached['version'] == ConfigManager.CACHE_VERSION and tuple(cached['stamp']) == stamp: return cached['config']
+        except (OSError, EOFError, ValueError, TypeError, KeyError): pass
+
+        import yaml
+        with open(self.configfile, 'r') as f: config = yaml.safe_load(f) or {}
+        self.writecache(config, stamp)
+        return config
+
+    def replace(self, path, content, mode = None):
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmpfile = tempfile.mkstemp(prefix = '.{}.'.format(os.path.basename(path)), dir = directory)
+        try :
+            if mode is not None: os.fchmod(fd, mode)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpfile, path)
+        except :
+            try : os.remove(tmpfile)
+            except OSError: pass
+            raise
+
+    def writecache(self, config, stamp):
+        #Without the cache the config is parsed again next time, so failing to write it is not an error
+        try : self.replace(self.cachefile, marshal.dumps({'version' : ConfigManager.CACHE_VERSION, 'stamp' : stamp, 'config' : config}))
+        except (OSError, ValueError): pass
+
+    def update(self, dbname, conf, exists = None):
+        """
+        Sets the conf of a database, or removes it if conf is None. Returns its previous conf.
+        If exists is given, the database must or must not be already in the config on disk.
+        """
+        import yaml
+        with LockManager(self.configfile).exclusive():
+            config = dict(self.read(LockManager.stamp(self.configfile)))
+            if exists is True and dbname not in config: raise ValueError('The database does not exists')
+            if exists is False and dbname in config: raise ValueError('The database already exists')
+            previous = config.pop(dbname, None)
+            if conf is not None: config[dbname] = conf
+
+            content = yaml.dump(config, default_flow_style = False, allow_unicode = True).encode('utf-8')
+            mode = os.stat(self.configfile).st_mode & 0o777 if os.path.isfile(self.configfile) else None
+            self.replace(self.configfile, content, mode)
+
+            stamp = LockManager.stamp(self.configfile)
+            self.writecache(config, stamp)
+        self.config, self.stamp = config, stamp
+        return previous
+
+    def add(self, dbname, conf): self.update(dbname, conf, exists = False)
+
+    def remove(self, dbname): return self.update(dbname, None, exists = True)
+
+    def exists(self, file):
+        if file in self.found: return True
+        if not os.path.isfile(file): return False
+        self.found.add(file)
+        return True
+
+    def forget(self, file = None):
+        if file is None: self.found.clear()
+        else : self.found.discard(file)
+
+    def __contains__(self, dbname): return dbname in self.load()
+
+    def __getitem__(self, dbname): return self.load()[dbname]
+
+    def __iter__(self): return iter(self.load())
+
+    def __len__(self): return len(self.load())
+
+    def keys(self): return self.load().keys()
+
+    def get(self, dbname, default = None): return self.load().get(dbname, default)
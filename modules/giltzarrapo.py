@@ -5,26 +5,221 @@
     #Propagar a encrypt y decrypt
 
 import os
+import io
 import sys
 import math
+import mmap
+import stat
 import getopt
+import tempfile
 from getpass import getuser
-from random import randint
-from operator import itemgetter
+from random import sample, SystemRandom
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from Crypto import Random
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA, SHA256, SHA512
 from Crypto.PublicKey import RSA
+from profiler import Profiler
+
+#Optional. Scores the entropy of every block at once. Only encrypt needs it, so it is imported on first use
+numpy = None
+numpy_checked = False
+def optional_numpy():
+    """Returns the numpy module, or None if it is not installed"""
+    global numpy, numpy_checked
+    if not numpy_checked:
+        try : import numpy
+        except ImportError: numpy = None
+        numpy_checked = True
+    return numpy
+
+class FileBlocks:
+    """Read only sequence of the blocks of an open file. Blocks are readed from the file on demand"""
+
+    def __init__(self, f, offset, chunkSize):
+        self.f = f
+        self.offset = offset
+        self.chunkSize = chunkSize
+        self.size = os.fstat(f.fileno()).st_size - offset
+
+    def __len__(self): return (self.size + self.chunkSize - 1) // self.chunkSize
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1: raise ValueError('Only contiguous slices are supported')
+            if stop <= start: return []
+
+            self.f.seek(self.offset + start * self.chunkSize)
+            data = self.f.read((stop - start) * self.chunkSize)
+            return [data[i:i + self.chunkSize] for i in range(0, len(data), self.chunkSize)]
+
+        if index < 0: index += len(self)
+        if index < 0 or index >= len(self): raise IndexError('Block index out of range')
+        self.f.seek(self.offset + index * self.chunkSize)
+        return self.f.read(self.chunkSize)
+
+    def view(self, start = 0, stop = None):
+        """Returns the contents of the blocks from start to stop"""
+        if stop is None: stop = len(self)
+        self.f.seek(self.offset + start * self.chunkSize)
+        return self.f.read(max(0, stop - start) * self.chunkSize)
+
+class MappedBlocks:
+    """Read only sequence of the blocks of a memory mapped file. Blocks are only copied out of the mapping when accessed"""
+
+    def __init__(self, mapping, offset, chunkSize):
+        self.mapping = mapping
+        self.offset = offset
+        self.chunkSize = chunkSize
+        self.size = len(mapping) - offset
+
+    def __len__(self): return (self.size + self.chunkSize - 1) // self.chunkSize
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1: raise ValueError('Only contiguous slices are supported')
+            return [self.mapping[self.offset + i * self.chunkSize:self.offset + (i + 1) * self.chunkSize] for i in range(start, stop)]
+
+        if index < 0: index += len(self)
+        if index < 0 or index >= len(self): raise IndexError('Block index out of range')
+        return self.mapping[self.offset + index * self.chunkSize:self.offset + (index + 1) * self.chunkSize]
+
+    def view(self, start = 0, stop = None):
+        """Returns a memoryview over the mapped blocks from start to stop"""
+        if stop is None: stop = len(self)
+        return memoryview(self.mapping)[self.offset + start * self.chunkSize:self.offset + min(self.size, stop * self.chunkSize)]
+
+    def copy(self): return BlockStore(self.chunkSize, self.view())
+
+    def wipe(self): self.mapping.close()
+
+class BlockStore:
+    """
+    Blocks of a file stored contiguously in a single bytearray.
+    Indexing returns copies of the blocks, view() returns memoryviews over the buffer.
+    Ciphers are applied in place and wipe() overwrites the buffer before releasing it
+    """
+
+    def __init__(self, chunkSize, data = b''):
+        self.chunkSize = chunkSize
+        self.data = bytearray(data)
+
+    @staticmethod
+    def read(f, chunkSize):
+        """Read the rest of an open file directly into the buffer"""
+        store = BlockStore(chunkSize)
+        store.data = bytearray(max(0, os.fstat(f.fileno()).st_size - f.tell()))
+        del store.data[f.readinto(store.data):]
+        return store
+
+    @property
+    def size(self): return len(self.data)
+
+    def __len__(self): return (len(self.data) + self.chunkSize - 1) // self.chunkSize
+
+    def bounds(self, index):
+        if index < 0: index += len(self)
+        if index < 0 or index >= len(self): raise IndexError('Block index out of range')
+        return index * self.chunkSize, min(len(self.data), (index + 1) * self.chunkSize)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1: raise ValueError('Only contiguous slices are supported')
+            return [bytes(self.data[i * self.chunkSize:(i + 1) * self.chunkSize]) for i in range(start, stop)]
+
+        start, stop = self.bounds(index)
+        return bytes(self.data[start:stop])
+
+    def __setitem__(self, index, block):
+        start, stop = self.bounds(index)
+        if len(block) != stop - start and stop != len(self.data): raise ValueError('Only the last block can change its size')
+        self.data[start:stop] = block
+
+    def view(self, start = 0, stop = None):
+        """Returns a memoryview over the blocks from start to stop. The buffer can not change its size while a view is alive"""
+        if stop is None: stop = len(self)
+        return memoryview(self.data)[start * self.chunkSize:stop * self.chunkSize]
+
+    def extend(self, data):
+        """Append data filling first the last block"""
+        self.data += data
+
+    def cipher(self, cipher, selected_block, key_block, run, source = None, executor = None):
+        """
+        Ciphers every block in place, with a single cipher call for each contiguous run of at most run blocks.
+        If a source is given, its blocks are ciphered into this buffer instead. The symetric block is replaced by key_block.
+        If an executor is given the runs are ciphered concurrently, each one into its own slice of the buffer
+        """
+        if source is None: source = self
+        else : self.data = bytearray(source.size)
+        runs = [(i, min(last, i + run)) for first, last in [(0, selected_block), (selected_block + 1, len(self))] for i in range(first, last, run)]
+
+        with memoryview(self.data) as view:
+            def work(blocks):
+                view[blocks[0] * self.chunkSize:blocks[1] * self.chunkSize] = cipher(bytes(source.view(*blocks)))
+
+            if executor is None:
+                for blocks in runs: work(blocks)
+            else : list(executor.map(work, runs))
+        self[selected_block] = key_block
+        return self
+
+    def copy(self): return BlockStore(self.chunkSize, self.data)
+
+    def wipe(self):
+        """Overwrite the buffer before releasing it"""
+        self.data[:] = bytes(len(self.data))
+        self.data = bytearray()
 
 class Giltzarrapo:
-    def __init__(self, chunkSize = 512):
+    #Encrypted file format. Files without the magic bytes are v1 files
+    MAGIC = b'GLTZ'
+    VERSION = 2
+
+    #Parsed rsa keys by (path, mtime, size, passphrase digest)
+    keycache = {}
+
+    #Blocks ciphered with a single aes call. Longer runs stop fitting in the cpu cache and get slower
+    RUN = 256
+
+    #Default blocks scored by rankBlocks with and without numpy. Bigger files are scored on a random sample of blocks
+    ENTROPY_SAMPLE = 512
+    ENTROPY_SAMPLE_PURE = 32
+
+    #Blocks with at least this fraction of the highest entropy are ranked first, in random order,
+    #so every encryption takes a different symetric block
+    ENTROPY_THRESHOLD = 0.9
+
+    #Default threads used to cipher data bigger than PARALLEL_THRESHOLD bytes
+    WORKERS = os.cpu_count() or 1
+    PARALLEL_THRESHOLD = 4 * 1024 * 1024
+
+    #Default fsync done by save before replacing the file
+    #   none : leave it to the os
+    #   file : sync the new file before it replaces the old one
+    #   full : sync the directory too, so the rename survives a power loss
+    DURABILITY = 'file'
+    DURABILITY_LEVELS = ['none', 'file', 'full']
+
+    def __init__(self, chunkSize = 512, workers = None, parallel_threshold = None, entropy_sample = None):
         self.chunkSize = chunkSize
-        self.blocks = []
+        self.blocks = BlockStore(chunkSize)
         self.info = {}
         self.status = None
+        self.readonly = False
+        self.workers = workers if workers is not None else Giltzarrapo.WORKERS
+        self.parallel_threshold = parallel_threshold if parallel_threshold is not None else Giltzarrapo.PARALLEL_THRESHOLD
+        #None scores ENTROPY_SAMPLE blocks, or ENTROPY_SAMPLE_PURE without numpy
+        if entropy_sample is not None and entropy_sample < 1: raise ValueError('The entropy sample must be at least one block')
+        self.entropy_sample = entropy_sample
 
     @staticmethod
-    def generateRSApair(passphrase = "", dir = None, name = "giltza_rsa"):
+    def generateRSApair(passphrase = "", dir = None, name = "giltza_rsa", key = None):
         if dir != None:
             #Replace ~ for the user's home
             if '~' in dir : dir = '/home/{}/{}'.format(getuser(), dir[len(dir) - ''.join(list(reversed(dir))).index('~') + 1:])
@@ -37,7 +232,8 @@ class Giltzarrapo:
         privKey = file_template
         pubKey = '{}.pub'.format(file_template)
 
-        key = RSA.generate(4096, Random.new().read)
+        #Use the given key pair if it was generated ahead of time
+        if key is None: key = RSA.generate(4096, Random.new().read)
         try :
             with open(privKey, 'wb') as priv, open(pubKey, 'wb') as pub:
                 priv.write(key.exportKey("PEM", passphrase = passphrase))
@@ -45,6 +241,50 @@ class Giltzarrapo:
         except PermissionError: raise PermissionError('Write permision denied at : {}'.format(file_template))
         return privKey, pubKey
 
+    @staticmethod
+    def importKey(key, passphrase = None):
+        """Returns the parsed rsa key of a key file. Already parsed key objects are returned as they are"""
+        if not isinstance(key, str): return key
+
+        keystat = os.stat(key)
+        passphrase_digest = SHA256.new(bytes(passphrase or '', encoding = 'utf-8')).digest()
+        cache_key = (key, keystat.st_mtime_ns, keystat.st_size, passphrase_digest)
+        if cache_key in Giltzarrapo.keycache: return Giltzarrapo.keycache[cache_key]
+
+        with Profiler.span('key import'), open(key, 'rb') as keyf: RSAkey = RSA.importKey(keyf.read(), passphrase = passphrase)
+        Giltzarrapo.forgetKeys(key)
+        Giltzarrapo.keycache[cache_key] = RSAkey
+        return RSAkey
+
+    @staticmethod
+    def importPubKey(pubkey):
+        #A missing file is found when opening it, so a cached key costs a single stat
+        try : PUBkey = Giltzarrapo.importKey(pubkey)
+        except FileNotFoundError: raise ValueError('No such file or directory : {}'.format(pubkey))
+        except ValueError: raise KeyError('Wrong key format')
+        except PermissionError: raise PermissionError('Read permission denied : {}'.format(pubkey))
+        if PUBkey.has_private(): raise KeyError('Wrong key format')
+        return PUBkey
+
+    @staticmethod
+    def importPrivKey(privkey, passphrase):
+        try : PRIVkey = Giltzarrapo.importKey(privkey, passphrase)
+        except FileNotFoundError: raise ValueError('No such file or directory : {}'.format(privkey))
+        except ValueError: raise ValueError('Wrong or required passphrase')
+        except PermissionError: raise PermissionError('Read permission denied : {}'.format(privkey))
+        if not PRIVkey.has_private(): raise KeyError('Wrong key format')
+        return PRIVkey
+
+    @staticmethod
+    def forgetKeys(path = None):
+        """Drop the parsed keys of a key file from the cache, or every parsed key if no file is given"""
+        for cache_key in list(Giltzarrapo.keycache.keys()):
+            if path is None or cache_key[0] == path: del Giltzarrapo.keycache[cache_key]
+
+    @staticmethod
+    def keyBytes(key):
+        return (key.size() + 8) // 8
+
     @staticmethod
     def entropy(string):
         """Calculates the Shannon entropy of a string"""
@@ -54,22 +294,97 @@ class Giltzarrapo:
 
         return (- sum([ p * math.log(p) / math.log(2.0) for p in prob ]))
 
-    def selectBlock(self, tryLimit = 5):
-        try_blocks = [randint(0, len(self.blocks) - 1) for _ in range(tryLimit)]
-        blocks_entropy = { block_index : Giltzarrapo.entropy(self.blocks[block_index].hex()) for block_index in try_blocks}
-        selected_block = max(blocks_entropy.items(), key = itemgetter(1))[0]
-
-        return selected_block
+    @staticmethod
+    def blockEntropy(block):
+        """Calculates the Shannon entropy of the bytes of a block"""
+        return (- sum([ (c / len(block)) * math.log2(c / len(block)) for c in Counter(block).values() ]))
 
-    def verifySymetricBlock(self, selected_block, pubkey):
-        if self.status is None : raise TypeError('Must have a readed file in memory')
-        if not os.path.isfile(pubkey): raise ValueError('No such file or directory : {}'.format(pubkey))
+    @staticmethod
+    def blocksEntropy(data, chunkSize):
+        """Calculates with numpy the Shannon entropy of the bytes of every block in data, which must only hold full blocks"""
+        numpy = optional_numpy()
+        blocks = numpy.frombuffer(data, dtype = numpy.uint8).reshape(-1, chunkSize)
+
+        #Histogram of every block with a single bincount, shifting the bytes of each block to its own 256 bins
+        bins = (numpy.arange(len(blocks), dtype = numpy.int64)[:, None] * 256 + blocks).ravel()
+        counts = numpy.bincount(bins, minlength = len(blocks) * 256).reshape(-1, 256)
+
+        #H = log2(n) - sum(c * log2(c)) / n, taking c * log2(c) from a table
+        clogc = numpy.zeros(chunkSize + 1)
+        clogc[1:] = numpy.arange(1, chunkSize + 1) * numpy.log2(numpy.arange(1, chunkSize + 1))
+        return math.log2(chunkSize) - clogc[counts].sum(axis = 1) / chunkSize
+
+    def rankBlocks(self):
+        """
+        Returns candidate block indexes, first the ones above ENTROPY_THRESHOLD shuffled and then the rest from the highest to the lowest entropy.
+        Containers with up to entropy_sample blocks are fully scored, bigger ones on a random sample of that size.
+        The selected block is then only above the threshold of the sample maximum. As blocks of the same database have
+        similar entropy this stays close to the maximum of the whole file, see tests/test_giltzarrapo.py
+        """
+        nblocks = len(self.blocks)
+        if nblocks == 0: return []
+        numpy = optional_numpy()
+        if self.entropy_sample is not None: limit = self.entropy_sample
+        else : limit = Giltzarrapo.ENTROPY_SAMPLE if numpy is not None else Giltzarrapo.ENTROPY_SAMPLE_PURE
+        candidates = list(range(nblocks)) if nblocks <= limit else sorted(sample(range(nblocks), limit))
+
+        #The last block may not be full
+        scores = []
+        if candidates[-1] == nblocks - 1 and len(self.blocks[-1]) != self.chunkSize:
+            scores.append((Giltzarrapo.blockEntropy(self.blocks[-1]), candidates.pop()))
+
+        if numpy is None: scores.extend([(Giltzarrapo.blockEntropy(self.blocks[i]), i) for i in candidates])
+        elif len(candidates) > 0:
+            #Score every candidate at once. Leading contiguous blocks are scored without copying them
+            if candidates[-1] == len(candidates) - 1: data = self.blocks.view(0, len(candidates))
+            else : data = b''.join([self.blocks[i] for i in candidates])
+            scores.extend(zip(Giltzarrapo.blocksEntropy(data, self.chunkSize).tolist(), candidates))
+
+        scores.sort(key = lambda s: (-s[0], s[1]))
+        top = [i for e,i in scores if e >= scores[0][0] * Giltzarrapo.ENTROPY_THRESHOLD]
+        SystemRandom().shuffle(top)
+        return top + [i for e,i in scores[len(top):]]
 
-        try : PUBkey = RSA.importKey(open(pubkey, "rb").read())
-        except ValueError: raise KeyError('Wrong key format')
-        except PermissionError: raise PermissionError('Read permission denied : {}'.format(pubkey))
-        if PUBkey.has_private(): raise KeyError('Wrong key format')
+    @staticmethod
+    def windows(blocks, window):
+        """Yields the index of the first block and the blocks of contiguous windows of at most window blocks"""
+        for start in range(0, len(blocks), window): yield start, blocks[start:start + window]
 
+    @staticmethod
+    def bulk(blocks, start, selected_block, key_block, cipher, executor = None):
+        """
+        Yields the blocks ciphered in contiguous runs of at most RUN blocks, with a single cipher call per run.
+        The symetric block, if it is inside the blocks, is yielded apart as key_block.
+        If an executor is given the runs are ciphered concurrently and yielded in order
+        """
+        split = selected_block - start
+        if 0 <= split < len(blocks):
+            yield from Giltzarrapo.bulk(blocks[:split], 0, -1, None, cipher, executor)
+            yield key_block
+            yield from Giltzarrapo.bulk(blocks[split + 1:], 0, -1, None, cipher, executor)
+            return
+
+        runs = [b''.join(blocks[i:i + Giltzarrapo.RUN]) for i in range(0, len(blocks), Giltzarrapo.RUN)]
+        yield from (map(cipher, runs) if executor is None else executor.map(cipher, runs))
+
+    @contextmanager
+    def parallel(self, size):
+        """
+        Yields a thread pool to cipher size bytes, or None if they are too few to be worth splitting.
+        Threads are enough since the aes module releases the gil while ciphering, and ecb ciphers keep no state between calls
+        """
+        if self.workers <= 1 or size < self.parallel_threshold:
+            yield None
+            return
+
+        with ThreadPoolExecutor(max_workers = self.workers) as executor: yield executor
+
+    def selectBlock(self):
+        ranked = self.rankBlocks()
+        if len(ranked) == 0: raise ValueError('There are no blocks to select')
+        return ranked[0]
+
+    def checkBlockIndex(self, selected_block):
         if type(selected_block) != int:
             raise ValueError('The selected block must be an int')
         if selected_block > len(self.blocks) - 1 or selected_block < 0:
@@ -78,6 +393,12 @@ class Giltzarrapo:
                 'selected block >= 0'
             ))
 
+    def verifySymetricBlock(self, selected_block, pubkey):
+        if self.status is None : raise TypeError('Must have a readed file in memory')
+        PUBkey = Giltzarrapo.importPubKey(pubkey)
+
+        self.checkBlockIndex(selected_block)
+
         if selected_block == len(self.blocks) - 1:
             block_size = len(self.blocks[-1])
             b = self.blocks[-1] + os.urandom(self.chunkSize - block_size)
@@ -87,178 +408,358 @@ class Giltzarrapo:
         except : return False;
         return True;
          
-    def findBlock(self, passwd, privkey, passphrase):
-        if not os.path.isfile(privkey): raise ValueError('No such file or directory : {}'.format(privkey))
+    def makeLocator(self, selected_block, PUBkey):
+        """Encrypt the index of the symetric block so it can be found without searching for it"""
+        #The random prefix prevents guessing the index by encrypting every candidate with the public key
+        locator = os.urandom(32) + selected_block.to_bytes(8, byteorder='little')
+        with Profiler.span('rsa'): return PUBkey.encrypt(locator, 32)[0].rjust(Giltzarrapo.keyBytes(PUBkey), b'\x00')
 
-        try : PRIVkey = RSA.importKey(open(privkey, "rb").read(), passphrase = passphrase)
-        except ValueError: raise ValueError('Wrong or required passphrase')
-        except PermissionError: raise PermissionError('Read permission denied : {}'.format(privkey))
-        if not PRIVkey.has_private(): raise KeyError('Wrong key format')
+    def readLocator(self, PRIVkey):
+        if 'locator' not in self.info: return None
+
+        try :
+            with Profiler.span('rsa'): locator = PRIVkey.decrypt(self.info['locator'])
+        except : return None
 
-        for i,b in enumerate(self.blocks):
-            if self.info['fast'] :
-                passwd_hash = SHA512.new(bytes('{}{}{}'.format(self.info['challenge'].hex(), i, passwd), encoding='utf-8')).digest()
-                if passwd_hash != self.info['auth']: continue
+        selected_block = int.from_bytes(locator[-8:], byteorder='little')
+        return selected_block if selected_block < len(self.blocks) else None
 
-            try : block_hash = SHA256.new(PRIVkey.decrypt(b) + bytes(passwd, encoding = 'utf-8')).digest()
+    def findBlock(self, passwd, privkey, passphrase):
+        PRIVkey = Giltzarrapo.importPrivKey(privkey, passphrase)
+        return self._searchBlock(passwd, PRIVkey)[0]
+
+    def _searchBlock(self, passwd, PRIVkey):
+        """Returns the index of the symetric block, its decrypted content and its hash"""
+        if self.info['fast']:
+            #The auth hash identifies the block without any rsa operation
+            candidates = [i for i in range(len(self.blocks)) if SHA512.new(bytes('{}{}{}'.format(self.info['challenge'].hex(), i, passwd), encoding='utf-8')).digest() == self.info['auth']]
+        else :
+            #Only v1 files, written without locator, are searched block by block
+            located = self.readLocator(PRIVkey)
+            if located is not None: candidates = [located]
+            elif self.info.get('version', 1) < 2: candidates = range(len(self.blocks))
+            else : candidates = []
+
+        for i in candidates:
+            try :
+                with Profiler.span('rsa'): key_block = PRIVkey.decrypt(self.blocks[i]).rjust(self.chunkSize, b'\x00')
             except : continue
+            block_hash = SHA256.new(key_block + bytes(passwd, encoding = 'utf-8')).digest()
 
             signature = SHA.new(block_hash).digest()
-            if signature == self.info['challenge']: return i
+            if signature == self.info['challenge']: return i, key_block, block_hash
 
         raise ValueError('The symetric block could not be found. It may be caused by a wrong password and/or privkey')
 
     def readPlain(self, infile):
-        if not os.path.isfile(infile): raise ValueError('No such file or directory : {}'.format(infile))
-
-        blocks = []
         try :
-            with open(infile, 'rb') as inf:
-                bytes_read = inf.read(self.chunkSize)
-                while bytes_read:
-                    blocks.append(bytes_read)
-                    bytes_read = inf.read(self.chunkSize)
+            with Profiler.span('read'), open(infile, 'rb') as inf: blocks = BlockStore.read(inf, self.chunkSize)
+        except (FileNotFoundError, IsADirectoryError): raise ValueError('No such file or directory : {}'.format(infile))
         except PermissionError: raise PermissionError('Read permission denied : {}'.format(infile))
 
         self.blocks = blocks
         self.status = "plain"
+        self.readonly = False
         return self
 
     def encrypt(self, passwd, pubkey, selected_block = None, fast = True, try_max = 10):
-        try:
-            if try_max > 0: self._encrypt(passwd, pubkey, selected_block, fast)
-        except (KeyError, PermissionError) as e: raise e
-        except ValueError:
-            if selected_block == None: self.encrypt(passwd, pubkey, selected_block, fast, try_max - 1)
-            if self.status is not 'encrypted': raise ValueError('Error in RSA encryption for block {}'.format(selected_block))
+        with Profiler.span('encrypt'):
+            pubkey = Giltzarrapo.importPubKey(pubkey)
 
-        return self
+            #Try the blocks with the highest entropy until one is accepted by rsa
+            with Profiler.span('rank blocks'): candidates = self.rankBlocks()[:try_max] if selected_block == None else [selected_block]
+            for candidate in candidates:
+                try : return self._encrypt(passwd, pubkey, candidate, fast)
+                except ValueError: continue
 
-    def _encrypt(self, passwd, pubkey, selected_block = None, fast = True):
-        if not os.path.isfile(pubkey): raise ValueError('No such file or directory : {}'.format(pubkey))
+        raise ValueError('Error in RSA encryption for block {}'.format(selected_block))
 
-        try : PUBkey = RSA.importKey(open(pubkey, "rb").read())
-        except ValueError: raise KeyError('Wrong key format')
-        except PermissionError: raise PermissionError('Read permission denied : {}'.format(pubkey))
-        if PUBkey.has_private(): raise KeyError('Wrong key format')
+    def _encrypt(self, passwd, pubkey, selected_block = None, fast = True):
+        PUBkey = Giltzarrapo.importPubKey(pubkey)
 
         #Select a valid block as symetric key
         if selected_block == None: selected_block = self.selectBlock()
-        else:
-            if type(selected_block) != int:
-                raise ValueError('The selected block must be an int')
-            if selected_block > len(self.blocks) - 1 or selected_block < 0:
-                raise ValueError('The selected block ({}) must satisfy :\n\t{}\n\t{}'.format(selected_block,
-                    'selected block <= {}'.format(len(self.blocks) - 1),
-                    'selected block >= 0'
-                ))
+        else: self.checkBlockIndex(selected_block)
 
+        padded_block, encrypted_key_block, encryptor = self._prepareKey(passwd, PUBkey, selected_block, fast)
+        self.blocks[-1] = padded_block
+
+        #Encrypt the file
+        with Profiler.span('aes'), self.parallel(self.blocks.size) as executor:
+            self.blocks.cipher(encryptor.encrypt, selected_block, encrypted_key_block, Giltzarrapo.RUN, executor = executor)
+
+        self.status = "encrypted"
+        return self
+
+    def _prepareKey(self, passwd, PUBkey, selected_block, fast):
+        """Encrypts the symetric block and stores the info. Does not modify the blocks"""
         #Padding
         block_size = len(self.blocks[-1])
-        self.blocks[-1] = self.blocks[-1] + os.urandom(self.chunkSize - block_size)
+        padded_block = self.blocks[-1] + os.urandom(self.chunkSize - block_size)
+        key_block = padded_block if selected_block == len(self.blocks) - 1 else self.blocks[selected_block]
 
-        #Encrypt the file
-        hash_sha = SHA256.new(self.blocks[selected_block] + bytes(passwd, encoding = 'utf-8')).digest()
+        #Encrypt the symetric block first, so a block rejected by rsa leaves the data untouched for the next try.
+        #The rsa output is padded so every block keeps the chunk size
+        with Profiler.span('rsa'): encrypted_key_block = PUBkey.encrypt(key_block, 32)[0].rjust(self.chunkSize, b'\x00')
+
+        #Build the symetric key
+        hash_sha = SHA256.new(key_block + bytes(passwd, encoding = 'utf-8')).digest()
         hash_sha_sha = SHA.new(hash_sha).digest()
         encryptor = AES.new(hash_sha, AES.MODE_ECB, "")
 
         #Store the info
+        self.info['version'] = Giltzarrapo.VERSION
         self.info['fast'] = fast
         self.info['padding'] = self.chunkSize - block_size
         self.info['challenge'] = hash_sha_sha
         self.info['auth'] = SHA512.new(bytes('{}{}{}'.format(hash_sha_sha.hex(), selected_block, passwd), encoding='utf-8')).digest()
+        self.info['locator'] = self.makeLocator(selected_block, PUBkey)
 
-        #Encrypt the file
-        for i,b in enumerate(self.blocks):
-            self.blocks[i] = PUBkey.encrypt(b, 32)[0] if (i == selected_block) else encryptor.encrypt(b)
+        return padded_block, encrypted_key_block, encryptor
+
+    def encryptStream(self, infile, outfile, passwd, pubkey, selected_block = None, fast = True, try_max = 10, window = 2048):
+        """Encrypt infile into outfile processing windows of blocks, so the memory used does not depend on the file size"""
+        if not os.path.isfile(infile): raise ValueError('No such file or directory : {}'.format(infile))
+        if os.path.abspath(infile) == os.path.abspath(outfile): raise ValueError('The input and output files must be different')
+        PUBkey = Giltzarrapo.importPubKey(pubkey)
+
+        try :
+            with open(infile, 'rb') as inf:
+                self.blocks = FileBlocks(inf, 0, self.chunkSize)
+                self.status = 'plain'
+                if len(self.blocks) == 0: raise ValueError('There is no data to encrypt')
+
+                #Select a valid block as symetric key, trying the blocks with the highest entropy first
+                key = None
+                for try_block in (self.rankBlocks()[:try_max] if selected_block is None else [selected_block]):
+                    self.checkBlockIndex(try_block)
+                    try : key = self._prepareKey(passwd, PUBkey, try_block, fast)
+                    except ValueError: continue
+                    break
+                if key is None: raise ValueError('Error in RSA encryption for block {}'.format(selected_block))
+
+                with open(outfile, 'wb') as outf, self.parallel(self.blocks.size) as executor:
+                    self._writeHeader(outf)
+                    for data in self._encryptWindows(try_block, *key, window = window, executor = executor): outf.write(data)
+        except PermissionError: raise PermissionError('Permission denied : {} -> {}'.format(infile, outfile))
+        finally:
+            self.blocks = BlockStore(self.chunkSize)
+            self.status = None
 
-        self.status = "encrypted"
         return self
 
-    def readEncrypted(self, infile):
-        if not os.path.isfile(infile): raise ValueError('No such file or directory : {}'.format(infile))
+    def _encryptWindows(self, selected_block, padded_block, encrypted_key_block, encryptor, window, executor = None):
+        last_block = len(self.blocks) - 1
+        for start, blocks in Giltzarrapo.windows(self.blocks, window):
+            if start + len(blocks) - 1 == last_block: blocks[-1] = padded_block
+            yield b''.join(Giltzarrapo.bulk(blocks, start, selected_block, encrypted_key_block, encryptor.encrypt, executor))
 
-        blocks = []
+    @staticmethod
+    def _readHeader(inf):
         info = {}
+        if inf.read(len(Giltzarrapo.MAGIC)) == Giltzarrapo.MAGIC: info['version'] = int.from_bytes(inf.read(1), byteorder='little')
+        else :
+            info['version'] = 1
+            inf.seek(0)
+        if info['version'] > Giltzarrapo.VERSION: raise ValueError('Unsupported file format version : {}'.format(info['version']))
+
+        info['fast'] = bool.from_bytes(inf.read(1), byteorder='little')
+        info['padding'] = int.from_bytes(inf.read(2), byteorder='little')
+        info['challenge'] = inf.read(20)
+        if info['fast'] : info['auth'] = inf.read(64)
+        if info['version'] >= 2: info['locator'] = inf.read(int.from_bytes(inf.read(2), byteorder='little'))
+        return info
+
+    @staticmethod
+    def headerDigest(infile):
+        """
+        Returns the sha256 of the header of an encrypted file, or None if it can not be read.
+        The challenge and the locator are made again on every encryption, so it tells apart two writes
+        of the file even when they have the same size and modification time.
+        """
         try :
             with open(infile, 'rb') as inf:
-                info['fast'] = bool.from_bytes(inf.read(1), byteorder='little')
-                info['padding'] = int.from_bytes(inf.read(2), byteorder='little')
-                info['challenge'] = inf.read(20)
-                if info['fast'] : info['auth'] = inf.read(64)
-
-                bytes_read = inf.read(self.chunkSize)
-                while bytes_read:
-                    blocks.append(bytes_read)
-                    bytes_read = inf.read(self.chunkSize)
+                Giltzarrapo._readHeader(inf)
+                size = inf.tell()
+                inf.seek(0)
+                return SHA256.new(inf.read(size)).digest()
+        except (FileNotFoundError, ValueError): return None
+
+    def _writeHeader(self, outf):
+        version = self.info.get('version', 1)
+        #write the magic bytes and the format version. v1 files have no format header
+        if version >= 2:
+            outf.write(Giltzarrapo.MAGIC)
+            outf.write(version.to_bytes(1, byteorder='little'))
+        #write whether or not the fast mode is enabled
+        outf.write(self.info['fast'].to_bytes(1, byteorder='little'))
+        #write 2 bytes for the last block padding
+        outf.write(self.info['padding'].to_bytes(2, byteorder='little'))
+        #write the 20bytes of the SHA1
+        outf.write(self.info['challenge'])
+        #write the 64 bytes of the sha512 of the salted password if fast is enabled
+        if self.info['fast'] : outf.write(self.info['auth'])
+        #write 2 bytes for the locator length and the rsa encrypted index of the symetric block
+        if version >= 2:
+            outf.write(len(self.info['locator']).to_bytes(2, byteorder='little'))
+            outf.write(self.info['locator'])
+
+    def readEncrypted(self, infile, readonly = False):
+        """Map the file in memory. The blocks are not read until they are decrypted"""
+        try :
+            with Profiler.span('read'), open(infile, 'rb') as inf:
+                if os.fstat(inf.fileno()).st_size == 0: raise ValueError('Empty file : {}'.format(infile))
+                mapping = mmap.mmap(inf.fileno(), 0, access = mmap.ACCESS_READ)
+
+            try : info = Giltzarrapo._readHeader(mapping)
+            except :
+                mapping.close()
+                raise
+            blocks = MappedBlocks(mapping, mapping.tell(), self.chunkSize)
+        except (FileNotFoundError, IsADirectoryError): raise ValueError('No such file or directory : {}'.format(infile))
         except PermissionError: raise PermissionError('Read permission denied : {}'.format(infile))
 
         self.blocks = blocks
         self.info = info
         self.status = "encrypted"
+        self.readonly = readonly
+        return self
+
+    def upgrade(self, passwd, privkey, passphrase, pubkey):
+        """Convert readed v1 encrypted data to the current format without decrypting it"""
+        if self.status != 'encrypted': raise TypeError('Must have encrypted data in memory')
+        if self.info.get('version', 1) >= Giltzarrapo.VERSION: return self
+        PUBkey = Giltzarrapo.importPubKey(pubkey)
+
+        selected_block = self.findBlock(passwd, privkey, passphrase)
+        self.info['locator'] = self.makeLocator(selected_block, PUBkey)
+        self.info['version'] = Giltzarrapo.VERSION
         return self
 
     def decrypt(self, passwd, privkey, passphrase, selected_block = None):
-        if not os.path.isfile(privkey): raise ValueError('No such file or directory : {}'.format(privkey))
+        with Profiler.span('decrypt'):
+            PRIVkey = Giltzarrapo.importPrivKey(privkey, passphrase)
+            selected_block, key_block, encryptor = self._findKey(passwd, PRIVkey, passphrase, selected_block)
+
+            #Decrypt the file and remove the padding. Mapped files are decrypted into a new buffer
+            with Profiler.span('aes'), self.parallel(self.blocks.size) as executor:
+                if isinstance(self.blocks, MappedBlocks):
+                    mapped = self.blocks
+                    self.blocks = BlockStore(self.chunkSize).cipher(encryptor.decrypt, selected_block, key_block, Giltzarrapo.RUN, source = mapped, executor = executor)
+                    mapped.wipe()
+                else : self.blocks.cipher(encryptor.decrypt, selected_block, key_block, Giltzarrapo.RUN, executor = executor)
+            self.blocks[-1] = self.blocks[-1][:self.chunkSize - self.info['padding']]
 
-        try : PRIVkey = RSA.importKey(open(privkey, "rb").read(), passphrase = passphrase)
-        except ValueError: raise ValueError('Wrong or required passphrase')
-        except PermissionError: raise PermissionError('Read permission denied : {}'.format(privkey))
-        if not PRIVkey.has_private(): raise KeyError('Wrong key format')
+        self.status = "plain"
+        return self
 
+    def _findKey(self, passwd, PRIVkey, passphrase, selected_block = None):
+        """Returns the index and content of the symetric block and the aes decryptor"""
         #Found and check the selected block
         if selected_block == None:
-            selected_block = self.findBlock(passwd, privkey, passphrase)
-            block_hash = SHA256.new(PRIVkey.decrypt(self.blocks[selected_block]) + bytes(passwd, encoding = 'utf-8')).digest()
+            with Profiler.span('key block search'): selected_block, key_block, block_hash = self._searchBlock(passwd, PRIVkey)
         else:
-            if type(selected_block) != int:
-                raise ValueError('The selected block must be an int')
-            if selected_block > len(self.blocks) - 1 or selected_block < 0:
-                raise ValueError('The selected block ({}) must satisfy :\n\t{}\n\t{}'.format(selected_block,
-                    'selected block < {}'.format(len(self.blocks)),
-                    'selected block >= 0'
-                ))
-
-            try : block_hash = SHA256.new(PRIVkey.decrypt(self.blocks[selected_block]) + bytes(passwd, encoding = 'utf-8')).digest()
+            self.checkBlockIndex(selected_block)
+            try :
+                key_block = PRIVkey.decrypt(self.blocks[selected_block]).rjust(self.chunkSize, b'\x00')
+                block_hash = SHA256.new(key_block + bytes(passwd, encoding = 'utf-8')).digest()
             except : raise ValueError('Can not decrypt with {} as selected block'.format(selected_block))
 
             signature = SHA.new(block_hash).digest()
             if signature != self.info['challenge']: raise ValueError('Wrong selected block or wrong password')
 
-        encryptor = AES.new(block_hash)
+        return selected_block, key_block, AES.new(block_hash)
 
-        #Decrypt the file
-        for i,b in enumerate(self.blocks):
-            mode = PRIVkey if (i == selected_block) else encryptor
-            self.blocks[i] = mode.decrypt(b)[:self.chunkSize - self.info['padding']] if (i == (len(self.blocks) - 1)) else mode.decrypt(b)
+    def decryptStream(self, infile, outfile, passwd, privkey, passphrase, selected_block = None, window = 2048):
+        """Decrypt infile into outfile processing windows of blocks, so the memory used does not depend on the file size"""
+        if not os.path.isfile(infile): raise ValueError('No such file or directory : {}'.format(infile))
+        if os.path.abspath(infile) == os.path.abspath(outfile): raise ValueError('The input and output files must be different')
+        PRIVkey = Giltzarrapo.importPrivKey(privkey, passphrase)
+
+        try :
+            with open(infile, 'rb') as inf:
+                self.info = Giltzarrapo._readHeader(inf)
+                self.blocks = FileBlocks(inf, inf.tell(), self.chunkSize)
+                self.status = 'encrypted'
+                key = self._findKey(passwd, PRIVkey, passphrase, selected_block)
+
+                with open(outfile, 'wb') as outf, self.parallel(self.blocks.size) as executor:
+                    for data in self._decryptWindows(*key, window = window, executor = executor): outf.write(data)
+        except PermissionError: raise PermissionError('Permission denied : {} -> {}'.format(infile, outfile))
+        finally:
+            self.blocks = BlockStore(self.chunkSize)
+            self.status = None
 
-        self.status = "plain"
         return self
 
-    def save(self, outfile, export_auth = None):
-        if self.status == None: raise TypeError('There is no readed data to save')
+    def _decryptWindows(self, selected_block, key_block, encryptor, window, executor = None):
+        last_block = len(self.blocks) - 1
+        for start, blocks in Giltzarrapo.windows(self.blocks, window):
+            data = b''.join(Giltzarrapo.bulk(blocks, start, selected_block, key_block, encryptor.decrypt, executor))
+            yield data[:len(data) - self.info['padding']] if (start + len(blocks) - 1 == last_block) else data
 
-        try :
-            with open(outfile, 'wb') as outf:
-                if self.status == 'encrypted':
-                    #write whether or not the fast mode is enabled
-                    outf.write(self.info['fast'].to_bytes(1, byteorder='little'))
-                    #write 2 bytes for the last block padding
-                    outf.write(self.info['padding'].to_bytes(2, byteorder='little'))
-                    #write the 20bytes of the SHA1
-                    outf.write(self.info['challenge'])
-                    #write the 64 bytes of the sha512 of the salted password if fast is enabled
-                    if self.info['fast'] : outf.write(self.info['auth'])
-
-                for i,b in enumerate(self.blocks): outf.write(b)
+    @staticmethod
+    def atomicWrite(outfile, chunks, durability = None):
+        """
+        Write the chunks with a single writev to a temporary file in the same directory, which then replaces outfile.
+        A crash leaves either the old or the new file, never a truncated one
+        """
+        if durability is None: durability = Giltzarrapo.DURABILITY
+        if durability not in Giltzarrapo.DURABILITY_LEVELS: raise ValueError('Unknown durability level : {}'.format(durability))
+        directory = os.path.dirname(os.path.abspath(outfile))
+
+        try : fd, tmpfile = tempfile.mkstemp(dir = directory, prefix = '.{}.'.format(os.path.basename(outfile)), suffix = '.tmp')
         except PermissionError : raise PermissionError('Write permission denied : {}'.format(outfile))
 
         try :
-            if export_auth != None:
-                with open(export_auth, 'wb') as authf: authf.write(self.info['auth'])
-        except PermissionError : raise PermissionError('Write permission denied : {}'.format(export_auth))
+            #Keep the permissions of the replaced file. New files are only readable by the owner
+            if os.path.isfile(outfile): os.fchmod(fd, stat.S_IMODE(os.stat(outfile).st_mode))
+
+            views = [memoryview(c) for c in chunks if len(c) > 0]
+            while len(views) > 0:
+                written = os.writev(fd, views)
+                while written > 0:
+                    if written < len(views[0]):
+                        views[0] = views[0][written:]
+                        break
+                    written -= len(views.pop(0))
+
+            if durability != 'none': os.fsync(fd)
+            os.close(fd)
+            fd = None
+            os.replace(tmpfile, outfile)
+        except :
+            if fd is not None: os.close(fd)
+            if os.path.exists(tmpfile): os.remove(tmpfile)
+            raise
+
+        if durability == 'full':
+            dirfd = os.open(directory, os.O_RDONLY)
+            try : os.fsync(dirfd)
+            finally : os.close(dirfd)
+
+    def save(self, outfile, export_auth = None, durability = None):
+        if self.status == None: raise TypeError('There is no readed data to save')
+        if self.readonly: raise TypeError('The data was readed in read only mode')
+
+        #outfile is replaced, not truncated, so the blocks may still be mapped from it
+        with Profiler.span('save'):
+            header = io.BytesIO()
+            if self.status == 'encrypted': self._writeHeader(header)
+            Giltzarrapo.atomicWrite(outfile, [header.getbuffer(), self.blocks.view()], durability)
+
+            if export_auth != None: Giltzarrapo.atomicWrite(export_auth, [self.info['auth']], durability)
+
+    def copy(self):
+        g = Giltzarrapo(self.chunkSize, self.workers, self.parallel_threshold, self.entropy_sample)
+        g.blocks = self.blocks.copy()
+        g.info = dict(self.info)
+        g.status = self.status
+        g.readonly = self.readonly
+        return g
 
     def clear(self):
-        self.blocks = []
+        self.blocks.wipe()
         self.info = {}
         self.status = None
+        self.readonly = False
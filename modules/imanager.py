@@ -1,7 +1,7 @@
+import os
 import sys
+import shutil
 import readline
-from os import popen, listdir
-from os.path import isdir
 from printer import cprepare
 
 class InputManager:
@@ -12,24 +12,31 @@ class InputManager:
             'create', 'import', 'passgen', 'clear', 'help',
             'use', 'select', 'insert', 'remove', 'list',
             'changedbpass', 'changedbkey', 'export', 'version',
-            'exit'
+            'refresh', 'begin', 'commit', 'rollback', 'exit'
         ])
         self.commands_usage = {
             'create' : 'usage : create [dbname]',
             'import' : 'usage : import [dbfile]',
             'passgen' : 'usage : passgen [length] [alphabet]',
             'use' : 'usage : use [dbname]',
-            'select' : 'usage : select [service]',
-            'insert' : 'usage : insert [service] [user]',
-            'remove' : 'usage : remove [index]',
+            'select' : 'usage : select [--all] [service]',
+            'insert' : 'usage : insert [service] [user] [password]',
+            'remove' : 'usage : remove [index ...|filter ...]',
             'export' : 'usage : export [dbfile]'
         }
         self.commands_args_help = {
             'import' : {1 : 'ls'},
             'use' : {1 : 'existing_dbs'},
-            'export' : {1 : 'ls'}
+            'export' : {1 : 'ls'},
+            'select' : {1 : 'services'},
+            'insert' : {1 : 'services', 2 : 'users'},
+            'remove' : {'*' : 'filters'}
         }
 
+        #Session of the database in use, whose names are completed. Directory listings by path, kept until the directory changes
+        self.session = None
+        self.listings = {}
+
         self.cache = []
         self.autocompletion = True
         self.buffer = None
@@ -60,7 +67,7 @@ class InputManager:
 
     def displaymatches(self, substitution, matches, longest_match_length):
         line_buffer = readline.get_line_buffer()
-        columns = int(popen('stty size', 'r').read().split()[1])
+        columns = shutil.get_terminal_size().columns
         print()
 
         if matches == ['-', '_'] : self.command_help("passranoid>> {}", line_buffer, columns, line_buffer)
@@ -86,6 +93,31 @@ class InputManager:
 
         for line in display : print(line)
 
+    def listdir(self, directory):
+        """Returns the sorted names in the directory and the set of those that are directories"""
+        path = directory if directory != '' else '.'
+        try : mtime = os.stat(path).st_mtime_ns
+        except OSError: return [], set()
+        if path in self.listings and self.listings[path][0] == mtime: return self.listings[path][1:]
+
+        names, dirs = [], set(['.', '..'])
+        try :
+            for entry in os.scandir(path):
+                names.append(entry.name)
+                try :
+                    if entry.is_dir(): dirs.add(entry.name)
+                except OSError: pass
+        except OSError: return [], set()
+
+        names.sort()
+        self.listings[path] = (mtime, names, dirs)
+        return names, dirs
+
+    def names(self, field, prefix, service = None):
+        """Returns the service or user names of the database in use starting with prefix"""
+        if self.session is None: return []
+        return self.session.complete(field, prefix, service)
+
     def command_help(self, prompt, line_buffer, columns, real_buffer):
         buf = line_buffer.split(' ')
         if len(buf) == 1:
@@ -96,7 +128,7 @@ class InputManager:
         else:
             #Print help based on which is the actual argument
             arg_index = len(buf[1:])
-            try : h = self.commands_args_help[buf[0]][arg_index] #Get help type
+            try : h = self.commands_args_help[buf[0]].get(arg_index, self.commands_args_help[buf[0]].get('*')) #Get help type
             except : pass
             else :
                 if h ==  'existing_dbs':
@@ -108,9 +140,21 @@ class InputManager:
                     searching_pattern = paths[-1]
                     if buf[arg_index].startswith('/') : search_dir = '/{}'.format(search_dir)
 
-                    if search_dir == '' : options = listdir()
-                    else : options = listdir(search_dir)
-                    options += ['.', '..']
+                    options, dirs = self.listdir(search_dir)
+                    options = options + ['.', '..']
+                elif h == 'services':
+                    searching_pattern = buf[arg_index]
+                    options = self.names('service', searching_pattern)
+                elif h == 'users':
+                    searching_pattern = buf[arg_index]
+                    options = self.names('user', searching_pattern, service = buf[1])
+                elif h == 'filters':
+                    #Filters are service=<name> or user=<name>
+                    searching_pattern = buf[arg_index]
+                    field, value = searching_pattern.split('=', 1) if '=' in searching_pattern else (None, None)
+                    if field in ['service', 'user']: options = ['{}={}'.format(field, n) for n in self.names(field, value)]
+                    else : options = ['service=', 'user=']
+                else : options, searching_pattern = [], ''
 
                 #Prepare print template
                 if len(options) == 0: longest_match_length = 0
@@ -128,8 +172,7 @@ class InputManager:
 
                     #Add / if ls mode and a dir is autocompleted
                     if h == 'ls':
-                        full_path = '{}/{}'.format(search_dir, options[0]) if search_dir != '' else options[0]
-                        if isdir(full_path): readline.insert_text('/')
+                        if options[0] in dirs: readline.insert_text('/')
 
                 #For more than one option, print options
                 elif len(options) > 0:
@@ -139,8 +182,7 @@ class InputManager:
 
                     #Format the options to equal lenght. If ls mode, give blue color to dirs
                     if h == 'ls':
-                        path_template = '{}/{}'.format(search_dir, '{}') if search_dir != '' else '{}'
-                        options = [(cprepare(template.format('{}/'.format(o)), color = 'lblue') if isdir(path_template.format(o)) else template.format(o)) for o in options]
+                        options = [(cprepare(template.format('{}/'.format(o)), color = 'lblue') if o in dirs else template.format(o)) for o in options]
                     else : options = [template.format(o) for o in options]
 
                     self.print_matches(options, match_print_len, columns)
@@ -0,0 +1,93 @@
+import os
+import multiprocessing
+from binascii import hexlify
+from Crypto import Random
+from Crypto.PublicKey import RSA
+from utils import init_worker
+
+def _generate(pool_path, secret, bits):
+    key = RSA.generate(bits, Random.new().read)
+    keyfile = '{}/{}'.format(pool_path, hexlify(os.urandom(8)).decode('utf-8'))
+
+    #Write to a temporary file so a half written key is never taken from the pool. It is only readable by the owner
+    fd = os.open('{}.tmp'.format(keyfile), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as keyf: keyf.write(key.exportKey("PEM", passphrase = secret))
+    os.rename('{}.tmp'.format(keyfile), '{}.pem'.format(keyfile))
+
+class KeyManager:
+    """
+    Pool of rsa key pairs generated ahead of time in worker processes.
+
+    Keys are stored at keys_path/.pool encrypted with a random pool secret, which is kept next to them.
+    The keys, the secret and the pool directory are only readable by the owner.
+    Several processes may share a pool : each key is claimed by renaming it before reading it.
+    """
+
+    def __init__(self, keys_path, size = 2, bits = 4096):
+        self.pool_path = '{}/.pool'.format(keys_path)
+        self.size = size
+        self.bits = bits
+        self.workers = None
+        self.pending = 0
+
+        if not os.path.isdir(self.pool_path): os.mkdir(self.pool_path, 0o700)
+        for f in os.listdir(self.pool_path):
+            if f.endswith('.tmp'): os.remove('{}/{}'.format(self.pool_path, f))
+        self.secret = self.load_secret()
+
+    def load_secret(self):
+        secretfile = '{}/.secret'.format(self.pool_path)
+        if not os.path.isfile(secretfile):
+            #Another process may create it first, then its secret is used
+            try :
+                fd = os.open(secretfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, 'w') as secretf: secretf.write(hexlify(os.urandom(32)).decode('utf-8'))
+            except FileExistsError: pass
+
+        with open(secretfile, 'r') as secretf: return secretf.read().strip()
+
+    def available(self):
+        return sorted([f for f in os.listdir(self.pool_path) if f.endswith('.pem')])
+
+    def fill(self):
+        """Start generating in background the keys missing to complete the pool"""
+        missing = self.size - len(self.available()) - self.pending
+        if missing <= 0: return
+
+        if self.workers is None:
+            self.workers = multiprocessing.Pool(processes = min(self.size, multiprocessing.cpu_count()), initializer = init_worker, initargs = (10,))
+
+        for _ in range(missing):
+            self.pending += 1
+            self.workers.apply_async(_generate, (self.pool_path, self.secret, self.bits), callback = self._done, error_callback = self._done)
+
+    def _done(self, result): self.pending -= 1
+
+    def take(self):
+        """Returns a ready key pair or None if the pool is empty"""
+        for keyname in self.available():
+            #Claim the key first, so a key is never given to two processes sharing the pool
+            keyfile = '{}/{}.{}.claimed'.format(self.pool_path, keyname, os.getpid())
+            try : os.rename('{}/{}'.format(self.pool_path, keyname), keyfile)
+            except FileNotFoundError: continue
+
+            try :
+                with open(keyfile, 'rb') as keyf: key = RSA.importKey(keyf.read(), passphrase = self.secret)
+            except (ValueError, IndexError, TypeError, FileNotFoundError): key = None
+            finally :
+                try : os.remove(keyfile)
+                except FileNotFoundError: pass
+
+            if key is not None and key.size() + 1 == self.bits:
+                self.fill()
+                return key
+
+        self.fill()
+        return None
+
+    def close(self):
+        if self.workers is None: return
+        self.workers.terminate()
+        self.workers.join()
+        self.workers = None
+        self.pending = 0
@@ -0,0 +1,60 @@
+import os
+import time
+import fcntl
+from contextlib import contextmanager
+from profiler import Profiler
+
+class LockManager:
+    """
+    Advisory locks between the processes using a database.
+
+    The lock is taken on a <dbfile>.lock file next to the database, so the database itself can be
+    replaced while locked. Readers share the lock and writers hold it alone. A process waits at most
+    timeout seconds for a lock held by another one.
+    """
+
+    POLL = 0.05
+
+    def __init__(self, dbfile, timeout = 10):
+        self.dbfile = dbfile
+        self.lockfile = '{}.lock'.format(dbfile)
+        self.timeout = timeout
+
+    @staticmethod
+    def stamp(dbfile):
+        """Returns the inode, size and modification time of the file, which change whenever it is written"""
+        try : st = os.stat(dbfile)
+        except FileNotFoundError: return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def open(self):
+        try : return os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError: pass
+        try : return os.open(self.lockfile, os.O_RDONLY)
+        except OSError: return None
+
+    @contextmanager
+    def hold(self, shared = False):
+        fd = self.open()
+        #Without a lock file, as in a read only directory, there is no writer to wait for
+        if fd is None:
+            yield
+            return
+
+        try :
+            mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            deadline = time.time() + self.timeout
+            with Profiler.span('lock wait'):
+                while True:
+                    try :
+                        fcntl.flock(fd, mode | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.time() >= deadline: raise ValueError('The database {} is locked by another process'.format(self.dbfile))
+                        time.sleep(LockManager.POLL)
+            yield
+        finally : os.close(fd)
+
+    def shared(self): return self.hold(shared = True)
+
+    def exclusive(self): return self.hold(shared = False)
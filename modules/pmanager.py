@@ -1,7 +1,30 @@
 import os
+import csv
+import json
+import time
+from functools import wraps
 from random import randint
 from printer import cprint, cprepare, ctable
 from giltzarrapo import Giltzarrapo
+from rmanager import RecordManager, RecordIndex
+from lmanager import LockManager
+from profiler import Profiler
+from utils import init_worker
+
+def _select(dbname, conf, service, passwd, passphrase):
+    #The error is sent back as text, as not every exception can be pickled
+    try : return dbname, PasswdManager.select(conf, service, passwd, passphrase), None
+    except Exception as e: return dbname, None, str(e) or type(e).__name__
+
+def locked(readonly = False):
+    """Run the operation holding the lock of its database, shared by readers. Sessions take their own locks"""
+    def decorator(operation):
+        @wraps(operation)
+        def wrapper(conf, *args, **kwargs):
+            if InternalPasswdManager.in_session(conf, kwargs.get('session')): return operation(conf, *args, **kwargs)
+            with LockManager(conf['dbfile']).hold(shared = readonly): return operation(conf, *args, **kwargs)
+        return wrapper
+    return decorator
 
 class PasswdManager:
     verbose = False
@@ -12,116 +35,154 @@ class PasswdManager:
         else : return ''.join([alphabet[randint(0, len(alphabet) - 1)] for _ in range(length)])
 
     @staticmethod
-    def create(dbname, passwd, passphrase, databases_path, keys_path):
+    def create(dbname, passwd, passphrase, databases_path, keys_path, keypool = None):
         if PasswdManager.verbose: print(cprepare('Creating', color = 'blue'), cprepare(dbname, color = 'lblue'), cprepare('database', color = 'blue'))
         g = Giltzarrapo()
-        InternalPasswdManager.append(g, 'passranoid_database:v1.1\tpassranoid_interface:v1.2\tpassranoid_config:v1\n')
+        g.blocks.extend(RecordManager.build(['passranoid_database:v2', 'passranoid_interface:v1.2', 'passranoid_config:v1'], []))
         g.status = 'plain'
 
-        if PasswdManager.verbose: cprint('Generating rsa key pair', color = 'blue')
-        privkey, pubkey = Giltzarrapo.generateRSApair(passphrase, dir = keys_path, name = dbname)
+        key = InternalPasswdManager.pooledkey(keypool)
+        privkey, pubkey = Giltzarrapo.generateRSApair(passphrase, dir = keys_path, name = dbname, key = key)
         if PasswdManager.verbose: print(cprepare('Keys saved at :\n  - Privkey :', color = 'blue'), cprepare(privkey, color = 'lblue'), cprepare('\n  - Pubkey :', color = 'blue'), cprepare(pubkey, color = 'lblue'))
 
         if PasswdManager.verbose: print(cprepare('Saving database at :', color = 'blue'), cprepare('{}/{}'.format(databases_path, dbname), color = 'lblue'))
         g.encrypt(passwd, pubkey).save('{}/{}'.format(databases_path, dbname))
 
     @staticmethod
-    def insert(conf, service, user, spasswd, passwd, passphrase):
-        if PasswdManager.verbose: cprint('Reading and decrypting database', color = 'blue')
-        g = Giltzarrapo().readEncrypted(conf['dbfile']).decrypt(passwd, conf['privkey'], passphrase)
+    @locked()
+    def insert(conf, service, user, spasswd, passwd, passphrase, session = None):
+        g = InternalPasswdManager.load(conf, passwd, passphrase, session)
 
         if PasswdManager.verbose: cprint('Inserting new row', color = 'blue')
         if spasswd == '': spasswd = PasswdManager.passgen()
-        InternalPasswdManager.append(g, '{}\t{}\t{}\n'.format(service, user, spasswd))
+        InternalPasswdManager.append(g, [service, user, spasswd], InternalPasswdManager.index(conf, session))
         if PasswdManager.verbose: ctable(header = ['service', 'user', 'password'], data = [[service, user, spasswd]], header_color = 'blue', rows_color = 'lblue')
 
-        if PasswdManager.verbose: cprint('Saving modified database', color = 'blue')
-        g.encrypt(passwd, conf['pubkey']).save(conf['dbfile'])
+        InternalPasswdManager.store(g, conf, passwd, session)
 
     @staticmethod
-    def list(conf, passwd, passphrase):
-        if PasswdManager.verbose: cprint('Reading and decrypting database', color = 'blue')
-        g = Giltzarrapo().readEncrypted(conf['dbfile']).decrypt(passwd, conf['privkey'], passphrase)
+    @locked(readonly = True)
+    def list(conf, passwd, passphrase, session = None):
+        g = InternalPasswdManager.load(conf, passwd, passphrase, session, readonly = True)
 
         if PasswdManager.verbose: cprint('Fetching rows', color = 'blue')
-        lines = InternalPasswdManager.getlines(g, '*')
-
-        if PasswdManager.verbose: cprint('Refreshing database', color = 'blue')
-        g.encrypt(passwd, conf['pubkey']).save(conf['dbfile'])
-        return lines
+        if InternalPasswdManager.in_session(conf, session): return session.getlines('*')
+        return InternalPasswdManager.getlines(g, '*')
 
     @staticmethod
-    def select(conf, service, passwd, passphrase):
-        if PasswdManager.verbose: cprint('Reading and decrypting database', color = 'blue')
-        g = Giltzarrapo().readEncrypted(conf['dbfile']).decrypt(passwd, conf['privkey'], passphrase)
+    @locked(readonly = True)
+    def select(conf, service, passwd, passphrase, session = None):
+        g = InternalPasswdManager.load(conf, passwd, passphrase, session, readonly = True)
 
         if PasswdManager.verbose: cprint('Fetching matching rows', color = 'blue')
-        lines = InternalPasswdManager.getlines(g, service)
+        if InternalPasswdManager.in_session(conf, session): return session.getlines(service)
+        return InternalPasswdManager.getlines(g, service)
 
-        if PasswdManager.verbose: cprint('Refreshing database', color = 'blue')
-        g.encrypt(passwd, conf['pubkey']).save(conf['dbfile'])
-        return lines
+    @staticmethod
+    def selectall(databases, service, session = None):
+        """
+        Select in many databases at once. databases maps every database name to its [conf, passwd, passphrase].
+        Every database is decrypted in its own worker process, except the one in session, which is already decrypted.
+        Returns the matches as (dbname, id, row) and the error of every database that could not be searched, by name
+        """
+        if PasswdManager.verbose: cprint('Searching in {} databases'.format(len(databases)), color = 'blue')
+        pending = [(dbname, conf, service, passwd, passphrase) for dbname, (conf, passwd, passphrase) in databases.items() if not InternalPasswdManager.in_session(conf, session)]
+
+        results, errors, workers = {}, {}, None
+        if len(pending) > 0:
+            import multiprocessing
+            workers = multiprocessing.Pool(processes = min(len(pending), multiprocessing.cpu_count()), initializer = init_worker)
+            pooled = workers.starmap_async(_select, pending)
+
+        try :
+            #The database in session is searched meanwhile in this process
+            for dbname, (conf, passwd, passphrase) in databases.items():
+                if InternalPasswdManager.in_session(conf, session): results[dbname] = PasswdManager.select(conf, service, passwd, passphrase, session = session)
+            if workers is not None:
+                for dbname, result, error in pooled.get():
+                    if error is None: results[dbname] = result
+                    else : errors[dbname] = error
+        finally :
+            if workers is not None:
+                workers.terminate()
+                workers.join()
+
+        matches = [(dbname, i, row) for dbname in databases if dbname in results for i,row in results[dbname]]
+        return matches, errors
 
     @staticmethod
-    def remove(conf, index, passwd, passphrase):
-        if PasswdManager.verbose: cprint('Reading and decrypting database', color = 'blue')
-        g = Giltzarrapo().readEncrypted(conf['dbfile']).decrypt(passwd, conf['privkey'], passphrase)
+    @locked()
+    def remove(conf, index, passwd, passphrase, session = None):
+        g = InternalPasswdManager.load(conf, passwd, passphrase, session)
 
         if PasswdManager.verbose: cprint('Removing matching rows', color = 'blue')
-        if index == '*' : removerows = [l[1].encode('utf-8') for l in InternalPasswdManager.getlines(g, '*')]
+        rows = range(len(RecordManager(g.blocks.data)))
+        if index == '*' : indexes = list(rows)
+        elif isinstance(index, dict): indexes = InternalPasswdManager.match(g, index, InternalPasswdManager.index(conf, session))
         else :
-            try : removerows = InternalPasswdManager.getlines(g, '*')[index][1].encode('utf-8')
+            try : indexes = sorted(set([rows[i] for i in (index if isinstance(index, list) else [index])]))
             except IndexError: return False
-        InternalPasswdManager.remove(g, removerows)
+        if len(indexes) == 0: return 0
 
-        if PasswdManager.verbose: cprint('Saving modified database', color = 'blue')
-        g.encrypt(passwd, conf['pubkey']).save(conf['dbfile'])
-        return True
+        InternalPasswdManager.remove(g, indexes, InternalPasswdManager.index(conf, session))
+        InternalPasswdManager.store(g, conf, passwd, session)
+        return len(indexes)
 
     @staticmethod
-    def version(conf, passwd, passphrase):
-        if PasswdManager.verbose: cprint('Reading and decrypting database', color = 'blue')
-        g = Giltzarrapo().readEncrypted(conf['dbfile']).decrypt(passwd, conf['privkey'], passphrase)
+    @locked(readonly = True)
+    def version(conf, passwd, passphrase, session = None):
+        g = InternalPasswdManager.load(conf, passwd, passphrase, session, readonly = True)
 
         if PasswdManager.verbose: cprint('Fetching database version', color = 'blue')
-        version = InternalPasswdManager.getversion(g)
+        return InternalPasswdManager.getversion(g)
+
+    @staticmethod
+    @locked()
+    def refresh(conf, passwd, passphrase, session = None):
+        """Re-encrypt the database choosing a new random symetric key block. Upgrades old format databases"""
+        g = InternalPasswdManager.load(conf, passwd, passphrase, session)
 
         if PasswdManager.verbose: cprint('Refreshing database', color = 'blue')
-        g.encrypt(passwd, conf['pubkey']).save(conf['dbfile'])
-        return version
+        if InternalPasswdManager.in_session(conf, session): session.rekey()
+        else : g.encrypt(passwd, conf['pubkey']).save(conf['dbfile'])
 
     @staticmethod
-    def changedbpass(conf, newpasswd, passwd, passphrase):
-        if PasswdManager.verbose: cprint('Reading and decrypting database', color = 'blue')
-        g = Giltzarrapo().readEncrypted(conf['dbfile']).decrypt(passwd, conf['privkey'], passphrase)
+    @locked()
+    def changedbpass(conf, newpasswd, passwd, passphrase, session = None):
+        g = InternalPasswdManager.load(conf, passwd, passphrase, session)
 
         if PasswdManager.verbose: cprint('Encrypting database with the new password', color = 'blue')
-        g.encrypt(newpasswd, conf['pubkey']).save(conf['dbfile'])
+        if InternalPasswdManager.in_session(conf, session): session.rekey(passwd = newpasswd)
+        else : g.encrypt(newpasswd, conf['pubkey']).save(conf['dbfile'])
 
     @staticmethod
-    def changedbkey(conf, newpassphrase, passwd, passphrase):
-        if PasswdManager.verbose: cprint('Reading and decrypting database', color = 'blue')
-        g = Giltzarrapo().readEncrypted(conf['dbfile']).decrypt(passwd, conf['privkey'], passphrase)
+    @locked()
+    def changedbkey(conf, newpassphrase, passwd, passphrase, session = None, keypool = None):
+        g = InternalPasswdManager.load(conf, passwd, passphrase, session)
 
-        if PasswdManager.verbose: cprint('Generating rsa key pair', color = 'blue')
+        key = InternalPasswdManager.pooledkey(keypool)
         keys_path, keyname = '/'.join(conf['privkey'].split('/')[:-1]), conf['privkey'].split('/')[-1]
         os.rename(conf['privkey'], '{}/.old.{}'.format(keys_path, keyname))
         os.rename(conf['pubkey'], '{}/.old.{}.pub'.format(keys_path, keyname))
-        privkey, pubkey = Giltzarrapo.generateRSApair(newpassphrase, dir = keys_path, name = keyname)
+        privkey, pubkey = Giltzarrapo.generateRSApair(newpassphrase, dir = keys_path, name = keyname, key = key)
+        Giltzarrapo.forgetKeys(conf['privkey'])
+        Giltzarrapo.forgetKeys(conf['pubkey'])
         if PasswdManager.verbose: print(cprepare('Old keys moved to :\n  - Privkey :', color = 'blue'), cprepare('{}/.old.{}'.format(keys_path, keyname), color = 'lblue'), cprepare('\n  - Pubkey :', color = 'blue'), cprepare('{}/.old.{}.pub'.format(keys_path, keyname), color = 'lblue'))
         if PasswdManager.verbose: print(cprepare('New keys saved at :\n  - Privkey :', color = 'blue'), cprepare(privkey, color = 'lblue'), cprepare('\n  - Pubkey :', color = 'blue'), cprepare(pubkey, color = 'lblue'))
 
         if PasswdManager.verbose: cprint('Encrypting database with the new key pair', color = 'blue')
-        g.encrypt(passwd, pubkey).save(conf['dbfile'])
+        if InternalPasswdManager.in_session(conf, session): session.rekey(passphrase = newpassphrase)
+        else : g.encrypt(passwd, pubkey).save(conf['dbfile'])
 
     @staticmethod
-    def exportdb(conf, dbfile, passwd, passphrase):
-        if PasswdManager.verbose: cprint('Reading and decrypting database', color = 'blue')
-        g = Giltzarrapo().readEncrypted(conf['dbfile']).decrypt(passwd, conf['privkey'], passphrase)
+    @locked(readonly = True)
+    def exportdb(conf, dbfile, passwd, passphrase, session = None):
+        g = InternalPasswdManager.load(conf, passwd, passphrase, session, readonly = True)
 
         if PasswdManager.verbose: cprint('Fetching rows', color = 'blue')
         header = '\t'.join(['service', 'user', 'password'])
-        lines = [l for i,l in InternalPasswdManager.getlines(g, '*')]
+        if InternalPasswdManager.in_session(conf, session): lines = ['\t'.join(l) for i,l in session.getlines('*')]
+        else : lines = ['\t'.join(l) for i,l in InternalPasswdManager.getlines(g, '*')]
         if len(lines) == 0: return False
 
         if PasswdManager.verbose: print(cprepare('Saving plain database rows at :', color = 'blue'), cprepare(dbfile, color = 'lblue'))
@@ -129,28 +190,25 @@ class PasswdManager:
         return True
 
     @staticmethod
-    def importdb(conf, dbfile, passwd, passphrase):
-        if PasswdManager.verbose: cprint('Reading and decrypting database', color = 'blue')
-        g = Giltzarrapo().readEncrypted(conf['dbfile']).decrypt(passwd, conf['privkey'], passphrase)
+    @locked()
+    def importdb(conf, dbfile, passwd, passphrase, session = None):
+        g = InternalPasswdManager.load(conf, passwd, passphrase, session)
 
-        if PasswdManager.verbose: print(cprepare('Reading plain exported file :', color = 'blue'), cprepare(dbfile, color = 'lblue'))
-        content = InternalPasswdManager.readfile(dbfile)
-        header_fields = ['service', 'user', 'password']
-        old_header, lines = content[0].split('\t'), [l.split('\t') for l in content[1:]]
-        line_template = '{}\n'.format('\t'.join([('{}' if h in header_fields else ' ') for h in old_header]))
+        if PasswdManager.verbose: print(cprepare('Streaming rows from', color = 'blue'), cprepare(dbfile, color = 'lblue'), cprepare('into', color = 'blue'), cprepare(conf['dbfile'].split('/')[-1], color = 'lblue'))
+        start = time.time()
+        rows = InternalPasswdManager.extend(g, InternalPasswdManager.progress(InternalPasswdManager.readrows(dbfile), start), InternalPasswdManager.index(conf, session))
 
-        if PasswdManager.verbose: print(cprepare('Inserting rows in', color = 'blue'), cprepare(conf['dbfile'].split('/')[-1], color = 'lblue'), cprepare('database', color = 'blue'))
-        for l in lines: InternalPasswdManager.append(g, line_template.format(*l))
-
-        if PasswdManager.verbose: cprint('Saving modified database', color = 'blue')
-        g.encrypt(passwd,conf['pubkey']).save(conf['dbfile'])
+        InternalPasswdManager.store(g, conf, passwd, session)
+        return rows, time.time() - start
 
     @staticmethod
-    def verifyauth(conf, passwd, passphrase):
+    @locked(readonly = True)
+    def verifyauth(conf, passwd, passphrase, session = None):
         if PasswdManager.verbose: cprint('Verifying database credentials', color = 'blue')
         try :
-            g = Giltzarrapo().readEncrypted(conf['dbfile']).decrypt(passwd, conf['privkey'], passphrase)
-            g.encrypt(passwd, conf['pubkey']).save(conf['dbfile'])
+            #The session keeps the decrypted database for the following commands
+            if InternalPasswdManager.in_session(conf, session): session.open()
+            else : Giltzarrapo().readEncrypted(conf['dbfile'], readonly = True).decrypt(passwd, conf['privkey'], passphrase).clear()
         except : return False
         if PasswdManager.verbose: cprint('Successfully verification', color = 'green')
         return True
@@ -158,54 +216,108 @@ class PasswdManager:
 class InternalPasswdManager:
 
     @staticmethod
-    def append(g, newline):
-        newline = bytes(newline, encoding = 'utf-8')
+    def in_session(conf, session):
+        return session is not None and session.conf == conf
 
-        if len(g.blocks) > 0:
-            b, l = len(g.blocks[-1]), len(newline)
+    @staticmethod
+    def index(conf, session):
+        """Returns the service index kept by the session, if the database is the one in session"""
+        return session.index if InternalPasswdManager.in_session(conf, session) else None
 
-            #try to fill the last block
-            if l > (g.chunkSize - b):
-                g.blocks[-1] = g.blocks[-1] + newline[0:g.chunkSize - b]
-                newline = newline[g.chunkSize - b:]
-            else :
-                g.blocks[-1] = g.blocks[-1] + newline[0:l]
-                newline = newline[l:]
+    @staticmethod
+    def load(conf, passwd, passphrase, session = None, readonly = False):
+        if InternalPasswdManager.in_session(conf, session):
+            if PasswdManager.verbose: cprint('Using in-memory database', color = 'blue')
+            return session.get()
 
-        #Append new full blocks
-        while len(newline) > g.chunkSize:
-            g.blocks.append(newline[0:g.chunkSize])
-            newline = newline[g.chunkSize:]
+        if PasswdManager.verbose: cprint('Reading and decrypting database', color = 'blue')
+        g = Giltzarrapo().readEncrypted(conf['dbfile'], readonly = readonly).decrypt(passwd, conf['privkey'], passphrase)
+        migrated = InternalPasswdManager.migrate(g)
+        if PasswdManager.verbose and (migrated or g.info['version'] < Giltzarrapo.VERSION): cprint('Old database format. Use refresh to upgrade it', color = 'orange')
+        return g
 
-        #Add the remaining part of the new line
-        if len(newline) > 0: g.blocks.append(newline)
+    @staticmethod
+    def migrate(g):
+        """Convert in memory a decrypted text database to the binary record layout. Returns whether it was converted"""
+        if RecordManager.isrecords(g.blocks.data): return False
+        #Keep the header of the file, which stays in the old layout until the database is written
+        g.info['layout'] = g.blocks.data[:g.blocks.data.find(b'\n')].decode('utf-8')
+        g.blocks.data[:] = RecordManager.migrate(g.blocks.data)
+        return True
 
     @staticmethod
-    def getlines(g, service):
-        lines = ''.join([b.decode('utf-8') for b in g.blocks]).split('\n')[1:-1] #Exclude last empty line and version line
-        lines = [(i,l) for i,l in enumerate(lines)]
-        if service != '*': lines = [l for l in lines if l[1].split('\t')[0] == service]
-        return lines
+    def pooledkey(keypool = None):
+        key = keypool.take() if keypool is not None else None
+        if PasswdManager.verbose:
+            if key is not None: cprint('Using a pregenerated rsa key pair', color = 'blue')
+            else : cprint('Generating rsa key pair', color = 'blue')
+        return key
 
     @staticmethod
-    def getversion(g):
-        return ''.join([b.decode('utf-8') for b in g.blocks]).split('\n')[0]
+    def store(g, conf, passwd, session = None):
+        if InternalPasswdManager.in_session(conf, session):
+            if PasswdManager.verbose: cprint('Marking in-memory database as modified', color = 'blue')
+            session.modified()
+            return
+
+        if PasswdManager.verbose: cprint('Saving modified database', color = 'blue')
+        g.encrypt(passwd, conf['pubkey']).save(conf['dbfile'])
 
     @staticmethod
-    def remove(g, rlines):
-        payload = bytes()
-        for b in g.blocks: payload += b
+    def append(g, row, index = None):
+        InternalPasswdManager.extend(g, [row], index)
 
-        #Remove bytes from the payload
-        if isinstance(rlines, list):
-            for r in rlines:
-                payload = payload[:payload.index(r)] + payload[payload.index(r) + len(r) + 1:]
-        else : payload = payload[:payload.index(rlines)] + payload[payload.index(rlines) + len(rlines) + 1:]
+    @staticmethod
+    def extend(g, rows, index = None):
+        """Append the rows, which may be a generator. Returns the number of appended rows"""
+        records = RecordManager(g.blocks.data)
+        first, services = len(records), []
+
+        def tracked():
+            for r in rows:
+                services.append(r[0])
+                yield r
+        records.extend(tracked())
+
+        #Index the rows only once they have been appended, so a failed import leaves the index untouched
+        if index is not None:
+            for i,s in enumerate(services): index.add(s, first + i)
+        return len(services)
 
-        #pull payload to g.blocks
-        newbcount = (len(payload) // g.chunkSize)
-        if (len(payload) // g.chunkSize) != (len(payload) / g.chunkSize): newbcount += 1
-        g.blocks = [payload[g.chunkSize*i:g.chunkSize*(i+1)] for i in range(newbcount)]
+    @staticmethod
+    def getlines(g, service, index = None):
+        """Returns the (index, fields) of the rows of a service. Use * for every row and end the service with * to match a prefix"""
+        records = RecordManager(g.blocks.data)
+        with Profiler.span('parse'):
+            if service == '*': return [(i,l) for i,l in enumerate(records.rows())]
+            if index is None: index = RecordIndex(records)
+            return [(i, records.row(i)) for i in index.lookup(service)]
+
+    @staticmethod
+    def match(g, filters, index = None):
+        """Returns the indexes of the rows matching every {'service', 'user'} filter. Values ending with * match a prefix"""
+        records = RecordManager(g.blocks.data)
+        if 'service' in filters:
+            if index is None: index = RecordIndex(records)
+            indexes = index.lookup(filters['service'])
+        else : indexes = list(range(len(records)))
+
+        if 'user' in filters:
+            user = filters['user']
+            if user.endswith('*'): indexes = records.where(lambda fields: fields[1].startswith(user[:-1]), indexes)
+            else : indexes = records.where(lambda fields: fields[1] == user, indexes)
+        return indexes
+
+    @staticmethod
+    def getversion(g):
+        """Returns the header of the file, which is the one of the old layout if the database was only migrated in memory"""
+        if 'layout' in g.info: return g.info['layout']
+        return '\t'.join(RecordManager(g.blocks.data).header())
+
+    @staticmethod
+    def remove(g, indexes, index = None):
+        RecordManager(g.blocks.data).remove(indexes)
+        if index is not None: index.remove(indexes)
 
     @staticmethod
     def savefile(header, lines, file):
@@ -213,8 +325,60 @@ class InternalPasswdManager:
             f.write('{}\n'.format(header))
             for l in lines: f.write('{}\n'.format(l))
 
+    #Names given to the service, user and password columns by common password manager exports, by preference
+    columns = [
+        ['service', 'name', 'title', 'account', 'url', 'website', 'web site', 'login_uri', 'origin_url'],
+        ['user', 'username', 'login_username', 'login name', 'login', 'email', 'username_value'],
+        ['password', 'login_password', 'password_value', 'pass']
+    ]
+
+    @staticmethod
+    def readrows(file):
+        """
+        Yields the [service, user, password] rows of an exported file as they are parsed.
+        Accepts tsv (like the export command), csv and json lines files
+        """
+        with open(file, 'r', newline = '', encoding = 'utf-8-sig') as f:
+            first = f.readline()
+            f.seek(0)
+
+            if file.endswith(('.jsonl', '.ndjson', '.json')) or first.lstrip().startswith('{'):
+                for n,line in enumerate(f, 1):
+                    if line.strip() == '': continue
+                    try : item = json.loads(line)
+                    except ValueError as e: raise ValueError('line {} : {}'.format(n, e))
+                    if not isinstance(item, dict): raise ValueError('line {} : Not a json object'.format(n))
+                    item = InternalPasswdManager.flatten(item)
+                    yield [next((str(item[c]) for c in names if item.get(c) not in [None, '']), '') for names in InternalPasswdManager.columns]
+                return
+
+            if file.endswith('.tsv') or '\t' in first: reader = csv.reader(f, delimiter = '\t', quoting = csv.QUOTE_NONE)
+            else : reader = csv.reader(f)
+
+            try :
+                header = [h.strip().lower() for h in next(reader, [])]
+                positions = [next((header.index(c) for c in names if c in header), None) for names in InternalPasswdManager.columns]
+                if positions[0] is None or positions[2] is None: raise ValueError('Unknown export format : {}'.format(file))
+
+                for l in reader:
+                    if len(l) == 0: continue
+                    yield [(l[p] if p is not None and p < len(l) else '') for p in positions]
+            except csv.Error as e: raise ValueError('line {} : {}'.format(reader.line_num, e))
+
+    @staticmethod
+    def flatten(item, prefix = ''):
+        """Lower case keys of a json object, with nested objects as prefix_key"""
+        flat = {}
+        for k,v in item.items():
+            if isinstance(v, dict): flat.update(InternalPasswdManager.flatten(v, '{}{}_'.format(prefix, k.lower())))
+            else : flat['{}{}'.format(prefix, k.lower())] = v
+        return flat
+
     @staticmethod
-    def readfile(file):
-        with open(file, 'r') as f:
-            lines = [l.split('\n')[0] for l in f]
-        return lines
+    def progress(rows, start, every = 10000):
+        """Passes the rows through, printing the rows read and the rate every few rows in verbose mode"""
+        count = 0
+        for count,r in enumerate(rows, 1):
+            if PasswdManager.verbose and count % every == 0: cprint('  {} rows ({:.0f} rows/s)'.format(count, count / max(time.time() - start, 1e-6)), color = 'blue', end = '\r', flush = True)
+            yield r
+        if PasswdManager.verbose and count >= every: print()
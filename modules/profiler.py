@@ -0,0 +1,75 @@
+import json
+import time
+from printer import cprint, cprepare
+
+class Span:
+    """Times a phase of a command. Spans opened inside it are kept as its children"""
+    __slots__ = ('record', 'start')
+
+    def __init__(self, name):
+        self.record = [name, Profiler.depth, 0.0]
+
+    def __enter__(self):
+        Profiler.spans.append(self.record)
+        Profiler.depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.record[2] = time.perf_counter() - self.start
+        Profiler.depth -= 1
+        return False
+
+class NoSpan:
+    """Returned by Profiler.span while profiling is disabled, so a disabled span costs a call and a flag check"""
+    __slots__ = ()
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): return False
+
+class Profiler:
+    """
+    Time breakdown of the phases of every command.
+
+    Phases are timed with `with Profiler.span(name):` and nest. Profiler.end prints the
+    breakdown of the command and, if a logfile is set, appends it as a json line.
+    Spans are only recorded from the thread running the commands.
+    """
+
+    enabled = False
+    logfile = None
+
+    spans = []
+    depth = 0
+    start = None
+    nospan = NoSpan()
+
+    @staticmethod
+    def span(name):
+        if not Profiler.enabled: return Profiler.nospan
+        return Span(name)
+
+    @staticmethod
+    def begin():
+        if not Profiler.enabled: return
+        Profiler.spans = []
+        Profiler.depth = 0
+        Profiler.start = time.perf_counter()
+
+    @staticmethod
+    def end(command):
+        if not Profiler.enabled or Profiler.start is None: return
+        total = time.perf_counter() - Profiler.start
+        spans, Profiler.spans, Profiler.start = Profiler.spans, [], None
+        if command == '': return
+
+        print(cprepare('{}'.format(command), color = 'blue', mode = 'bold'), cprepare('{:.2f} ms'.format(total * 1000), color = 'lblue'))
+        for name, depth, seconds in spans:
+            print(cprepare('{}{:<{}}'.format('  ' * (depth + 1), name, 28 - 2 * depth), color = 'blue'), cprepare('{:>10.2f} ms'.format(seconds * 1000), color = 'lblue'))
+
+        if Profiler.logfile is None: return
+        entry = {'time' : time.time(), 'command' : command, 'total' : total, 'spans' : [{'name' : n, 'depth' : d, 'seconds' : s} for n,d,s in spans]}
+        try :
+            with open(Profiler.logfile, 'a') as logf: logf.write(json.dumps(entry) + '\n')
+        except OSError as e: cprint('Can not write the profile to {} : {}'.format(Profiler.logfile, e), color = 'red')
@@ -0,0 +1,203 @@
+import struct
+from bisect import bisect_left, insort
+
+class RecordManager:
+    """
+    Binary layout of the decrypted database :
+        magic (4) | layout version (1) | header record | row records | row offsets (4 each) | offsets position (4) | rows (4)
+
+    A record is its field count (1) followed by every field as its length (2) and its utf-8 bytes.
+    Any row is reached in O(1) through the offsets table, which is kept after the rows.
+    Works directly over the given bytearray, so the changes are made on the decrypted blocks.
+    """
+
+    MAGIC = b'PSRN'
+    VERSION = 2
+    FOOTER = struct.Struct('<II')
+
+    def __init__(self, data):
+        self.data = data
+
+    @staticmethod
+    def isrecords(data):
+        return data[:len(RecordManager.MAGIC)] == RecordManager.MAGIC
+
+    @staticmethod
+    def pack(fields):
+        encoded = [bytes(f, encoding = 'utf-8') for f in fields]
+        if len(encoded) > 0xff: raise ValueError('A row can not have more than 255 fields')
+        if any([len(e) > 0xffff for e in encoded]): raise ValueError('A field can not be longer than 65535 bytes')
+        return struct.pack('<B', len(encoded)) + b''.join([struct.pack('<H', len(e)) + e for e in encoded])
+
+    @staticmethod
+    def build(header, rows):
+        """Returns a new payload with the given header fields and rows"""
+        data = bytearray(RecordManager.MAGIC + struct.pack('<B', RecordManager.VERSION) + RecordManager.pack(header))
+        offsets = []
+        for r in rows:
+            offsets.append(len(data))
+            data += RecordManager.pack(r)
+
+        data += struct.pack('<{}I'.format(len(offsets)), *offsets) + RecordManager.FOOTER.pack(len(data), len(offsets))
+        return data
+
+    @staticmethod
+    def migrate(data):
+        """Returns the payload of a text database : a line per row with tab separated fields, after a line with the header"""
+        lines = data.decode('utf-8').split('\n')
+        header = lines[0].split('\t')
+        header[0] = 'passranoid_database:v{}'.format(RecordManager.VERSION)
+        return RecordManager.build(header, [l.split('\t') for l in lines[1:-1]])
+
+    def footer(self):
+        """Returns the position of the offsets table and the number of rows"""
+        return RecordManager.FOOTER.unpack_from(self.data, len(self.data) - RecordManager.FOOTER.size)
+
+    def __len__(self): return self.footer()[1]
+
+    def offsets(self):
+        table, count = self.footer()
+        return list(struct.unpack_from('<{}I'.format(count), self.data, table))
+
+    def offset(self, index):
+        table, count = self.footer()
+        if index < 0: index += count
+        if index < 0 or index >= count: raise IndexError('Row index out of range')
+        return struct.unpack_from('<I', self.data, table + 4 * index)[0]
+
+    def end(self, offset):
+        """Returns the position following the record at offset"""
+        fields, offset = self.data[offset], offset + 1
+        for _ in range(fields): offset += 2 + struct.unpack_from('<H', self.data, offset)[0]
+        return offset
+
+    def unpack(self, offset):
+        fields, offset = [], offset + 1
+        for _ in range(self.data[offset - 1]):
+            length = struct.unpack_from('<H', self.data, offset)[0]
+            fields.append(self.data[offset + 2:offset + 2 + length].decode('utf-8'))
+            offset += 2 + length
+        return fields
+
+    def key(self, offset):
+        """Returns only the first field of the record at offset"""
+        length = struct.unpack_from('<H', self.data, offset + 1)[0]
+        return self.data[offset + 3:offset + 3 + length].decode('utf-8')
+
+    def field(self, offset, n):
+        """Returns only the field n of the record at offset"""
+        offset += 1
+        for _ in range(n): offset += 2 + struct.unpack_from('<H', self.data, offset)[0]
+        length = struct.unpack_from('<H', self.data, offset)[0]
+        return self.data[offset + 2:offset + 2 + length].decode('utf-8')
+
+    def header(self): return self.unpack(len(RecordManager.MAGIC) + 1)
+
+    def row(self, index): return self.unpack(self.offset(index))
+
+    def rows(self): return [self.unpack(o) for o in self.offsets()]
+
+    def where(self, predicate, indexes = None):
+        """Returns the indexes, among the given ones or all of them, of the rows whose fields satisfy the predicate"""
+        if indexes is None: indexes = range(len(self))
+        return [i for i in indexes if predicate(self.row(i))]
+
+    def extend(self, rows):
+        """
+        Append the rows, which may be a generator, before the offsets table, which is rewritten once.
+        If the rows raise an error the appended records are discarded
+        """
+        table, count = self.footer()
+        offsets = bytearray(self.data[table:len(self.data) - RecordManager.FOOTER.size])
+        del self.data[table:]
+
+        try :
+            for r in rows:
+                record = RecordManager.pack(r)
+                offsets += struct.pack('<I', len(self.data))
+                self.data += record
+        except :
+            self.data[table:] = bytes(len(self.data) - table)
+            del self.data[table:]
+            self.data += offsets[:4 * count] + RecordManager.FOOTER.pack(table, count)
+            raise
+
+        self.data += offsets + RecordManager.FOOTER.pack(len(self.data), len(offsets) // 4)
+
+    def append(self, row): self.extend([row])
+
+    def remove(self, indexes):
+        """
+        Remove the rows at the given indexes in a single pass. The rows are marked in a tombstone table,
+        the kept records are moved down in place, the freed tail is zeroed and the offsets table rebuilt
+        """
+        offsets = self.offsets()
+        tombstones = bytearray(len(offsets))
+        for i in indexes: tombstones[i] = 1
+
+        write, kept = self.end(len(RecordManager.MAGIC) + 1), []
+        for i,o in enumerate(offsets):
+            if tombstones[i]: continue
+            end = self.end(o)
+            if o != write: self.data[write:write + end - o] = self.data[o:end]
+            kept.append(write)
+            write += end - o
+
+        self.data[write:] = bytes(len(self.data) - write)
+        del self.data[write:]
+        self.data += struct.pack('<{}I'.format(len(kept)), *kept) + RecordManager.FOOTER.pack(write, len(kept))
+
+class RecordIndex:
+    """
+    Row indexes by service name, the first field of every row.
+    Exact lookups go through a dict and prefix lookups through the sorted service names.
+    The sorted user names, the second field, are only built when completing them and dropped by any change.
+    """
+
+    def __init__(self, records):
+        self.rows = {}
+        for i,o in enumerate(records.offsets()): self.rows.setdefault(records.key(o), []).append(i)
+        self.services = sorted(self.rows)
+        self.users = None
+
+    @staticmethod
+    def prefixed(names, prefix):
+        """Returns the names of a sorted list starting with the prefix"""
+        start = end = bisect_left(names, prefix)
+        while end < len(names) and names[end].startswith(prefix): end += 1
+        return names[start:end]
+
+    def complete(self, prefix): return RecordIndex.prefixed(self.services, prefix)
+
+    def userlist(self, records):
+        if self.users is None: self.users = sorted(set([records.field(o, 1) for o in records.offsets()]))
+        return self.users
+
+    def add(self, service, index):
+        self.users = None
+        if service not in self.rows:
+            self.rows[service] = []
+            insort(self.services, service)
+        self.rows[service].append(index)
+
+    def remove(self, indexes):
+        """Drop the removed rows and move down the indexes of the rows after them"""
+        self.users = None
+        removed = set(indexes)
+        shifts = sorted(removed)
+        for service in list(self.rows):
+            kept = [i - bisect_left(shifts, i) for i in self.rows[service] if i not in removed]
+            if len(kept) > 0: self.rows[service] = kept
+            else :
+                del self.rows[service]
+                del self.services[bisect_left(self.services, service)]
+
+    def lookup(self, service):
+        """Returns the sorted indexes of the rows of a service, or of the services starting with the prefix before a trailing *"""
+        if not service.endswith('*'): return list(self.rows.get(service, []))
+
+        prefix, indexes = service[:-1], []
+        for i in range(bisect_left(self.services, prefix), len(self.services)):
+            if not self.services[i].startswith(prefix): break
+            indexes.extend(self.rows[self.services[i]])
+        return sorted(indexes)
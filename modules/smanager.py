@@ -0,0 +1,241 @@
+import time
+import threading
+from giltzarrapo import Giltzarrapo
+from pmanager import InternalPasswdManager
+from rmanager import RecordManager, RecordIndex
+from lmanager import LockManager
+from profiler import Profiler
+from printer import cprint
+
+class SessionManager:
+    """
+    Keeps a decrypted database in memory between commands.
+
+    Mutations only mark the session as dirty. The changes are written back
+    according to the flush policy :
+        immediate : encrypt and save after every mutation
+        exit : encrypt and save when the session is closed
+        N (int) : encrypt and save at most every N seconds
+
+    After timeout seconds without being used the plaintext and the parsed
+    keys are flushed and wiped from memory. They are transparently loaded
+    again on the next use.
+
+    While a transaction is open nothing is written and the session is not
+    evicted. commit writes every change at once and rollback restores the
+    database as it was at begin.
+
+    The file is read under a shared lock and written under an exclusive one.
+    A copy without changes is reloaded when another process writes the file.
+    A copy with changes is not written over theirs : the flush fails once, saving the changes to
+    <dbfile>.conflict encrypted with the same credentials, and the session loads their copy next.
+    """
+
+    def __init__(self, conf, passwd, passphrase, flush = 'immediate', timeout = 300):
+        self.conf = conf
+        self.passwd = passwd
+        self.passphrase = passphrase
+        self.flush_policy = SessionManager.parse_policy(flush)
+        self.timeout = timeout
+
+        self.g = None
+        self.index = None
+        self.lines = None
+        self.dirty = False
+        self.last_access = None
+        self.last_flush = None
+        self.snapshot = None
+        self.stamp = None
+
+        self.filelock = LockManager(conf['dbfile'])
+        self.lock = threading.RLock()
+        self.timer = None
+
+    @staticmethod
+    def parse_policy(policy):
+        if policy in ['immediate', 'exit']: return policy
+        try : seconds = int(policy)
+        except (TypeError, ValueError): raise ValueError('Unknown flush policy : {}'.format(policy))
+        if seconds <= 0: raise ValueError('The flush interval must be a positive number of seconds')
+        return seconds
+
+    def is_open(self): return self.g is not None
+
+    def version(self):
+        """The stat of the file and the digest of its header, as the stat alone may not change on a quick rewrite"""
+        return LockManager.stamp(self.conf['dbfile']), Giltzarrapo.headerDigest(self.conf['dbfile'])
+
+    def stale(self):
+        """Whether the file changed since it was read or written by this session"""
+        return self.version() != self.stamp
+
+    def open(self):
+        with self.lock:
+            #Reload a copy without changes written meanwhile by other processes
+            if self.g is not None and not self.dirty and self.snapshot is None and self.stale(): self.drop()
+
+            if self.g is None:
+                with self.filelock.shared():
+                    self.g = Giltzarrapo().readEncrypted(self.conf['dbfile']).decrypt(self.passwd, self.conf['privkey'], self.passphrase)
+                    self.stamp = self.version()
+                InternalPasswdManager.migrate(self.g)
+                with Profiler.span('index'): self.index = RecordIndex(RecordManager(self.g.blocks.data))
+                self.lines = None
+                self.dirty = False
+                self.last_flush = time.time()
+            self.last_access = time.time()
+            self._schedule()
+            return self.g
+
+    def get(self): return self.open()
+
+    def getlines(self, service):
+        with self.lock:
+            g = self.open()
+            if service != '*': return InternalPasswdManager.getlines(g, service, self.index)
+            if self.lines is None: self.lines = InternalPasswdManager.getlines(g, '*')
+            return list(self.lines)
+
+    def complete(self, field, prefix, service = None):
+        """
+        Returns the sorted service or user names starting with prefix, the users of the service if one is given.
+        Only completes while the database is in memory, it is never decrypted nor waited for to complete a name
+        """
+        if not self.lock.acquire(blocking = False): return []
+        try :
+            if self.g is None or self.index is None: return []
+            if field == 'service': return self.index.complete(prefix)
+
+            records = RecordManager(self.g.blocks.data)
+            if service is None: return RecordIndex.prefixed(self.index.userlist(records), prefix)
+            return sorted(set([u for u in [records.field(records.offset(i), 1) for i in self.index.lookup(service)] if u.startswith(prefix)]))
+        finally : self.lock.release()
+
+    def modified(self):
+        with self.lock:
+            self.dirty = True
+            self.lines = None
+            if self.flush_policy == 'immediate' and self.snapshot is None: self.flush()
+
+    def in_transaction(self): return self.snapshot is not None
+
+    def begin(self):
+        with self.lock:
+            if self.snapshot is not None: raise ValueError('A transaction is already open')
+            g = self.open()
+            self.snapshot = (bytearray(g.blocks.data), self.dirty)
+
+    def commit(self):
+        """Write every change made since begin with a single encryption"""
+        with self.lock:
+            if self.snapshot is None: raise ValueError('There is no open transaction')
+            self._drop_snapshot()
+            self.flush()
+
+    def rollback(self):
+        """Discard every change made since begin"""
+        with self.lock:
+            if self.snapshot is None: raise ValueError('There is no open transaction')
+            data, self.dirty = self.snapshot
+            self.g.blocks.data[:] = data
+            self.index = RecordIndex(RecordManager(self.g.blocks.data))
+            self.lines = None
+            self._drop_snapshot()
+
+    def _drop_snapshot(self):
+        self.snapshot[0][:] = bytes(len(self.snapshot[0]))
+        self.snapshot = None
+
+    def rekey(self, passwd = None, passphrase = None):
+        """Write the database with a new symetric key block and, optionally, new credentials"""
+        with self.lock:
+            self.open()
+            if passwd is not None: self.passwd = passwd
+            if passphrase is not None: self.passphrase = passphrase
+            self.dirty = True
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.g is None or not self.dirty: return
+            with Profiler.span('flush'), self.filelock.exclusive():
+                if self.stale():
+                    #Refuse to overwrite the other changes. Ours are kept in a copy next to the database, so the
+                    #session is no longer dirty : it is not written again and can still be evicted
+                    conflictfile = '{}.conflict'.format(self.conf['dbfile'])
+                    self.g.copy().encrypt(self.passwd, self.conf['pubkey']).save(conflictfile)
+                    self.dirty = False
+                    self.last_flush = time.time()
+                    raise ValueError('The database was modified by another process. The changes made since it was loaded were not written, they were saved at {}'.format(conflictfile))
+
+                self.g.copy().encrypt(self.passwd, self.conf['pubkey']).save(self.conf['dbfile'])
+                self.stamp = self.version()
+                self.g.info.pop('layout', None)
+            self.dirty = False
+            self.last_flush = time.time()
+
+    def evict(self):
+        """Flush the pending changes and wipe the plaintext from memory"""
+        with self.lock:
+            try : self.flush()
+            finally :
+                #Changes that could not be written anywhere stay in memory
+                if not self.dirty:
+                    self.drop()
+                    Giltzarrapo.forgetKeys(self.conf['privkey'])
+                    Giltzarrapo.forgetKeys(self.conf['pubkey'])
+
+    def drop(self):
+        """Wipe the plaintext from memory without writing it"""
+        with self.lock:
+            if self.g is not None: self.g.clear()
+            self.g = None
+            self.index = None
+            self.lines = None
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None: self.timer.cancel()
+            self.timer = None
+            if self.snapshot is not None:
+                cprint('Discarding the changes of the uncommitted transaction', color = 'orange')
+                self.rollback()
+            self.evict()
+
+    def _schedule(self):
+        if self.timer is not None: self.timer.cancel()
+        self.timer = None
+
+        deadlines = []
+        if self.timeout : deadlines.append(self.last_access + self.timeout)
+        if isinstance(self.flush_policy, int): deadlines.append(self.last_flush + self.flush_policy)
+        if len(deadlines) == 0: return
+
+        self.timer = threading.Timer(max(0, min(deadlines) - time.time()), self._tick)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _tick(self):
+        #Never block the timer thread while a command is using the session
+        if not self.lock.acquire(blocking = False):
+            self.timer = threading.Timer(1, self._tick)
+            self.timer.daemon = True
+            self.timer.start()
+            return
+
+        try:
+            self.timer = None
+            if self.g is None: return
+            now = time.time()
+
+            try :
+                #Nothing is written nor evicted until the open transaction ends
+                if self.snapshot is None:
+                    if isinstance(self.flush_policy, int) and now >= self.last_flush + self.flush_policy:
+                        if self.dirty: self.flush()
+                        else : self.last_flush = now
+                    if self.timeout and now >= self.last_access + self.timeout: self.evict()
+            except Exception as e: cprint('\nSession write-back failed : {}'.format(e), color = 'red')
+
+            if self.g is not None: self._schedule()
+        finally: self.lock.release()
@@ -0,0 +1,26 @@
+import os
+import sys
+
+def popoption(name, default):
+    """Removes the --name=value argument from sys.argv and returns its value, or default if it is not given"""
+    for arg in sys.argv:
+        if arg.startswith('{}='.format(name)):
+            sys.argv.remove(arg)
+            return arg[len(name) + 1:]
+    return default
+
+def popflag(*names):
+    """Removes every given flag from sys.argv and returns whether any was given"""
+    found = False
+    for name in names:
+        if name in sys.argv:
+            sys.argv.remove(name)
+            found = True
+    return found
+
+def init_worker(niceness = 0):
+    """Initializer of the worker processes : lower their priority by niceness and reseed the rng after the fork"""
+    #Imported here so the scripts parsing their arguments do not load pycrypto
+    from Crypto import Random
+    if niceness > 0: os.nice(niceness)
+    Random.atfork()
@@ -0,0 +1,7 @@
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+config="$DIR/config/passranoid.conf"
+modules_path="$DIR/modules"
+script_path="$DIR/script"
+
+export PYTHONPATH=$modules_path
+python3 $script_path/agent.py $config "$@"
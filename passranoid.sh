@@ -6,4 +6,7 @@ keys_path="$DIR/keys"
 script_path="$DIR/script"
 
 export PYTHONPATH=$modules_path
-python3 $script_path/passranoid.py $config $databases_path $keys_path $@
+case "$1" in
+    get|list|insert) python3 $script_path/oneshot.py $config $databases_path $keys_path "$@" ;;
+    *) python3 $script_path/passranoid.py $config $databases_path $keys_path $@ ;;
+esac
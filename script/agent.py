@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+import sys
+import os
+import json
+from getpass import getpass
+from printer import cprint, cprepare
+from utils import popoption, popflag
+
+def print_help():
+    title_color = {'color' : 'default', 'mode' : 'bold'}
+    primary_color = {'color' : 'blue', 'mode' : 'bold'}
+    secundary_color = {'color' : 'blue', 'mode' : 'normal'}
+
+    print(cprepare('Usage :', **title_color), cprepare('./passranoid-agent.sh [options] command [args]', **primary_color))
+    print(cprepare('Options :', **title_color))
+    print(cprepare('    --socket=path', **primary_color), cprepare(': Unix socket of the agent. Defaults to $PASSRANOID_AGENT_SOCK or a private runtime directory', **secundary_color))
+    print(cprepare('    --lifetime=seconds', **primary_color), cprepare(': Lock the databases unused for N seconds. 0 to keep them unlocked (default 0)', **secundary_color))
+    print(cprepare('    --lock-timeout=seconds', **primary_color), cprepare(': Maximum wait for a database used by another client (default 5)', **secundary_color))
+    print(cprepare('    --flush=policy', **primary_color), cprepare(': When to write the databases. immediate (default), exit or every N seconds', **secundary_color))
+    print(cprepare('    -f, --foreground', **primary_color), cprepare(': Do not detach the agent from the terminal', **secundary_color))
+    print(cprepare('    -h, --help', **primary_color), cprepare(': Print this message and exit\n', **secundary_color))
+
+    print(cprepare('Commands :\n', **title_color))
+    print(cprepare('  start [dbname ...]', **primary_color), cprepare(': Start the agent with the given databases unlocked', **secundary_color))
+    print(cprepare('  stop', **primary_color), cprepare(': Lock every database and stop the agent', **secundary_color))
+    print(cprepare('  status', **primary_color), cprepare(': List the unlocked databases', **secundary_color))
+    print(cprepare('  unlock [dbname]', **primary_color), cprepare(': Unlock a database in the running agent', **secundary_color))
+    print(cprepare('  lock [dbname]', **primary_color), cprepare(': Lock a database in the running agent', **secundary_color))
+    print(cprepare('  select [dbname] [service]', **primary_color), cprepare(': Print the matching entries as json', **secundary_color))
+    print(cprepare('  list [dbname]', **primary_color), cprepare(': Print all the entries as json', **secundary_color))
+    print(cprepare('  insert [dbname] [service] [user] [password]', **primary_color), cprepare(': Insert a new entry and print its password. An empty password is generated', **secundary_color))
+def askcredentials(dbname):
+    passwd = getpass('{} password: '.format(dbname))
+    passphrase = getpass('{} passphrase (Empty for no passphrase): '.format(dbname))
+    return passwd, passphrase
+def detach():
+    #Double fork so the agent is not a child of the calling shell
+    if os.fork() > 0: return False
+    os.setsid()
+    if os.fork() > 0: os._exit(0)
+
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3): os.dup2(devnull, fd)
+
+    #The rng of the parent must not be shared with the agent
+    from Crypto import Random
+    Random.atfork()
+    return True
+
+
+if popflag('-h', '--help') or len(sys.argv) < 3:
+    print_help()
+    sys.exit()
+foreground = popflag('-f', '--foreground')
+socket_path = popoption('--socket', None)
+try :
+    lifetime = int(popoption('--lifetime', 0))
+    lock_timeout = float(popoption('--lock-timeout', 5))
+except ValueError:
+    cprint('The lifetime and the lock timeout must be numbers', color = 'red')
+    sys.exit(1)
+flush = popoption('--flush', 'immediate')
+
+from aclient import AgentClient
+configfile, command, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+if socket_path is None: socket_path = os.environ.get('PASSRANOID_AGENT_SOCK', AgentClient.default_socket())
+
+if command == 'start':
+    #The agent and the crypto stack are only needed by the agent process
+    from pmanager import PasswdManager
+    from amanager import AgentManager
+    try : agent = AgentManager(configfile, socket_path, lifetime = lifetime, lock_timeout = lock_timeout, flush = flush)
+    except ValueError as e:
+        cprint(str(e), color = 'red')
+        sys.exit(1)
+    try : listening = AgentClient.listening(socket_path)
+    except ValueError as e:
+        cprint(str(e), color = 'red')
+        sys.exit(1)
+    if listening:
+        cprint('An agent is already listening at {}'.format(socket_path), color = 'red')
+        sys.exit(1)
+
+    #Verify every database before detaching, the sessions are opened by the agent process
+    credentials = {}
+    for dbname in args:
+        try : conf = agent.getconf(dbname)
+        except ValueError as e:
+            cprint(str(e), color = 'red')
+            sys.exit(1)
+        passwd, passphrase = askcredentials(dbname)
+        if not PasswdManager.verifyauth(conf, passwd, passphrase):
+            cprint('Wrong password or/and passphrase for {}'.format(dbname), color = 'red')
+            sys.exit(1)
+        credentials[dbname] = (passwd, passphrase)
+
+    if not foreground and not detach():
+        print('PASSRANOID_AGENT_SOCK={}; export PASSRANOID_AGENT_SOCK;'.format(socket_path))
+        sys.exit()
+
+    for dbname, (passwd, passphrase) in credentials.items(): agent.unlock(dbname, passwd, passphrase)
+    credentials = None
+    try : agent.serve()
+    except KeyboardInterrupt: pass
+    except ValueError as e:
+        cprint(str(e), color = 'red')
+        sys.exit(1)
+    sys.exit()
+
+requests = {
+    'stop' : [],
+    'status' : [],
+    'unlock' : ['db'],
+    'lock' : ['db'],
+    'select' : ['db', 'service'],
+    'list' : ['db'],
+    'insert' : ['db', 'service', 'user', 'password'],
+}
+if command not in requests:
+    cprint('Unknown command {}'.format(command), color = 'red')
+    sys.exit(1)
+if len(args) < len(requests[command]) and not (command == 'insert' and len(args) == 3):
+    cprint('Missing arguments. Usage : {} {}'.format(command, ' '.join(requests[command])), color = 'red')
+    sys.exit(1)
+
+request = dict(zip(requests[command], args))
+if command == 'unlock': request['passwd'], request['passphrase'] = askcredentials(request['db'])
+try : result = AgentClient.request(socket_path, command, **request)
+except (ConnectionError, FileNotFoundError):
+    cprint('No agent listening at {}'.format(socket_path), color = 'red')
+    sys.exit(1)
+except ValueError as e:
+    cprint(str(e), color = 'red')
+    sys.exit(1)
+
+if command == 'status': print('\n'.join(result))
+elif command == 'insert': print(result)
+elif command in ['select', 'list']: print(json.dumps([{'id' : i, 'service' : r[0], 'user' : r[1], 'password' : r[2]} for i,r in result]))
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+#Non interactive commands for shell scripts. Only the modules needed by the command are imported:
+#a running agent answers without importing the crypto stack, which is only loaded to decrypt the database here
+import sys
+import os
+import json
+from printer import cprint
+
+USAGE = [
+    'get [dbname] [service] [user] : Print the password of the entry. The user is only needed if the service has many',
+    'list [dbname] : Print every entry',
+    'insert [dbname] [service] [user] [password] : Insert a new entry and print its password. A missing password is generated',
+]
+
+def error(text):
+    cprint(text, color = 'red', file = sys.stderr)
+    return 1
+
+def getconf(configfile, dbname):
+    from confmanager import ConfigManager
+    config = ConfigManager(configfile)
+    if dbname not in config: raise ValueError('The database {} does not exists'.format(dbname))
+    return config[dbname]
+
+def agent(command, **kwargs):
+    """Returns the result of the agent, or None if there is no agent with the database unlocked"""
+    from aclient import AgentClient
+    socket_path = os.environ.get('PASSRANOID_AGENT_SOCK', AgentClient.default_socket())
+    if not os.path.exists(socket_path): return None
+
+    try : return AgentClient.request(socket_path, command, **kwargs)
+    except (ConnectionError, FileNotFoundError): return None
+    except ValueError as e:
+        if str(e) == 'The database {} is locked'.format(kwargs['db']): return None
+        raise
+
+def local(configfile, command, dbname, *args):
+    """Runs the command decrypting the database in this process. The credentials are asked in the terminal"""
+    from getpass import getpass
+    from pmanager import PasswdManager
+
+    conf = getconf(configfile, dbname)
+    passwd = getpass('{} password: '.format(dbname))
+    passphrase = getpass('{} passphrase (Empty for no passphrase): '.format(dbname))
+
+    if command == 'select': return PasswdManager.select(conf, args[0], passwd, passphrase)
+    if command == 'list': return PasswdManager.list(conf, passwd, passphrase)
+
+    service, user, spasswd = args
+    if spasswd == '': spasswd = PasswdManager.passgen()
+    PasswdManager.insert(conf, service, user, spasswd, passwd, passphrase)
+    return spasswd
+
+def run(configfile, command, args, as_json):
+    if command == 'get':
+        if len(args) < 2: raise ValueError('Missing arguments. Usage : get dbname service [user]')
+        dbname, service = args[0], args[1]
+        rows = agent('select', db = dbname, service = service)
+        if rows is None: rows = local(configfile, 'select', dbname, service)
+        if len(args) >= 3: rows = [(i,r) for i,r in rows if r[1] == args[2]]
+
+        if as_json: return json.dumps([{'id' : i, 'service' : r[0], 'user' : r[1], 'password' : r[2]} for i,r in rows])
+        if len(rows) == 0: raise ValueError('No matches')
+        if len(rows) > 1: raise ValueError('{} entries match. Give the user too : {}'.format(len(rows), ', '.join([r[1] for i,r in rows])))
+        return rows[0][1][2]
+
+    if command == 'list':
+        if len(args) < 1: raise ValueError('Missing arguments. Usage : list dbname')
+        rows = agent('list', db = args[0])
+        if rows is None: rows = local(configfile, 'list', args[0])
+
+        if as_json: return json.dumps([{'id' : i, 'service' : r[0], 'user' : r[1], 'password' : r[2]} for i,r in rows])
+        return '\n'.join(['\t'.join([str(i)] + r) for i,r in rows])
+
+    if command == 'insert':
+        if len(args) < 3: raise ValueError('Missing arguments. Usage : insert dbname service user [password]')
+        dbname, service, user = args[:3]
+        spasswd = args[3] if len(args) >= 4 else ''
+        password = agent('insert', db = dbname, service = service, user = user, password = spasswd)
+        if password is None: password = local(configfile, 'insert', dbname, service, user, spasswd)
+
+        if as_json: return json.dumps({'service' : service, 'user' : user, 'password' : password})
+        return password
+
+    raise ValueError('Unknown command {}. Available commands :\n  {}'.format(command, '\n  '.join(USAGE)))
+
+if __name__ == '__main__':
+    as_json = '--json' in sys.argv
+    if as_json: sys.argv.remove('--json')
+    if len(sys.argv) < 5: sys.exit(error('Usage : passranoid.sh command [--json] [args]\n  {}'.format('\n  '.join(USAGE))))
+
+    try : output = run(sys.argv[1], sys.argv[4], sys.argv[5:], as_json)
+    except ValueError as e: sys.exit(error(str(e)))
+    except (KeyboardInterrupt, EOFError): sys.exit(1)
+    print(output)
@@ -4,8 +4,11 @@ import os
 from os.path import isfile as isfile
 from getpass import getpass
 from pmanager import PasswdManager
+from giltzarrapo import Giltzarrapo
 from cmanager import CommandManager
+from profiler import Profiler
 from printer import cprint, cprepare, ctable
+from utils import popoption
 
 #TODO : remove database
 #TODO : change service user
@@ -22,14 +25,25 @@ def print_help(in_session = True):
         print(cprepare('Usage :', **title_color), cprepare('./passranoid.sh', **primary_color))
         print(cprepare('Options :', **title_color))
         print(cprepare('    -v, --verbose', **primary_color), cprepare(': Open session in verbose mode', **secundary_color))
+        print(cprepare('    --flush=policy', **primary_color), cprepare(': When to write the database in use. immediate (default), exit or every N seconds', **secundary_color))
+        print(cprepare('    --timeout=seconds', **primary_color), cprepare(': Wipe the decrypted database after N idle seconds. 0 to disable (default 300)', **secundary_color))
+        print(cprepare('    --keypool=N', **primary_color), cprepare(': Keep N rsa key pairs generated in background for create and changedbkey (default 0)', **secundary_color))
+        print(cprepare('    --profile[=file]', **primary_color), cprepare(': Print the time spent in every phase of each command. Also append it as json lines to file', **secundary_color))
+        print(cprepare('    --durability=level', **primary_color), cprepare(': fsync done when saving. none, file (default) or full to also sync the directory', **secundary_color))
+        print(cprepare('    --batch=file', **primary_color), cprepare(': Run the commands of the file, one per line, in a single transaction. Stops and rolls back at the first error. use, refresh, changedbpass and changedbkey commit the commands before them', **secundary_color))
         print(cprepare('    -h, --help', **primary_color), cprepare(': Print this message and exit\n', **secundary_color))
+        print(cprepare('One-shot commands, printing to stdout for scripts :', **title_color))
+        print(cprepare('    get [--json] dbname service [user]', **primary_color), cprepare(': Print the password of an entry', **secundary_color))
+        print(cprepare('    list [--json] dbname', **primary_color), cprepare(': Print every entry', **secundary_color))
+        print(cprepare('    insert [--json] dbname service user [password]', **primary_color), cprepare(': Insert a new entry and print its password', **secundary_color))
+        print(cprepare('    A running passranoid-agent with the database unlocked answers them without asking for the password\n', **tertiary_color))
 
     print(cprepare('Available commands {} :\n'.format('' if in_session else 'in session mode'), **title_color))
 
     print(cprepare('  create [dbname]', **primary_color), cprepare(': Create a new database', **secundary_color))
     print(cprepare('      dbname : New database name', **tertiary_color))
     print(cprepare('  import [dbfile]', **primary_color), cprepare(': Import a exported database into the one in use', **secundary_color))
-    print(cprepare('      dbfile : Exported database file to import', **tertiary_color))
+    print(cprepare('      dbfile : Exported database file to import. Accepts tsv, csv and json lines exports', **tertiary_color))
     print(cprepare('  passgen [length] [alphabet]', **primary_color), cprepare(': Generate a new password', **secundary_color))
     print(cprepare('      length : Length of the generated password', **tertiary_color))
     print(cprepare('      alphabet : Alphabet of the generated password', **tertiary_color))
@@ -37,23 +51,35 @@ def print_help(in_session = True):
     print(cprepare('  help', **primary_color), cprepare(': Show this help message', **secundary_color))
     print(cprepare('  use [dbname]', **primary_color), cprepare(': Load a database', **secundary_color))
     print(cprepare('      dbname : Name of the database to load', **tertiary_color))
-    print(cprepare('  add/insert [service] [user]', **primary_color), cprepare(': Insert a new entry', **secundary_color))
+    print(cprepare('  add/insert [service] [user] [password]', **primary_color), cprepare(': Insert a new entry', **secundary_color))
     print(cprepare('      service : Name of the service to insert', **tertiary_color))
     print(cprepare('      user : Name of the username/email of the service', **tertiary_color))
-    print(cprepare('  select [service]', **primary_color), cprepare(': Select entries by service', **secundary_color))
-    print(cprepare('      service : Name of the service to select', **tertiary_color))
-    print(cprepare('  rm/remove [index]', **primary_color), cprepare(': Remove entries by index', **secundary_color))
-    print(cprepare('      index : The index of the entry to remove', **tertiary_color))
+    print(cprepare('      password : Password of the service', **tertiary_color))
+    print(cprepare('  select [--all] [service]', **primary_color), cprepare(': Select entries by service', **secundary_color))
+    print(cprepare('      --all : Search in every database at once instead of the one in use', **tertiary_color))
+    print(cprepare('      service : Name of the service to select. End it with * to select by prefix', **tertiary_color))
+    print(cprepare('  rm/remove [index ...|filter ...]', **primary_color), cprepare(': Remove entries by index or by filter', **secundary_color))
+    print(cprepare('      index : The indexes of the entries to remove, separated by spaces or commas. Use * for all', **tertiary_color))
+    print(cprepare('      filter : service=<name> and/or user=<name>. End the name with * to match by prefix', **tertiary_color))
     print(cprepare('  ls/list', **primary_color), cprepare(': List all the entries in the loaded database', **secundary_color))
     print(cprepare('  changedbpass', **primary_color), cprepare(': Change the password of the loaded database', **secundary_color))
     print(cprepare('  changedbkey', **primary_color), cprepare(': Change the rsa pair of the loaded database', **secundary_color))
     print(cprepare('  export [dbfile]', **primary_color), cprepare(': Export loaded database', **secundary_color))
     print(cprepare('      dbfile : Name of the file to save the exported database', **tertiary_color))
     print(cprepare('  version', **primary_color), cprepare(': Show current version of the database', **secundary_color))
+    print(cprepare('  refresh', **primary_color), cprepare(': Re-encrypt the loaded database with a new random key block', **secundary_color))
+    print(cprepare('  begin', **primary_color), cprepare(': Start a transaction. The changes are kept in memory until commit', **secundary_color))
+    print(cprepare('  commit', **primary_color), cprepare(': Save all the changes of the transaction at once', **secundary_color))
+    print(cprepare('  rollback', **primary_color), cprepare(': Discard all the changes of the transaction', **secundary_color))
     print(cprepare('  Crtl+C/Ctrl+D/exit', **primary_color), cprepare(': Exit session mode', **secundary_color))
 
     print(cprepare('\nAll arguments are optional. If missing, they will be asked interactively', **title_color))
 def clear(): os.system('clear; clear')
+def batchlines(batchfile):
+    with open(batchfile, 'r') as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if line != '' and not line.startswith('#'): yield n, line
 
 
 if ('-h' in sys.argv) or ('--help' in sys.argv):
@@ -64,89 +90,177 @@ if ('-v' in sys.argv) or ('--verbose' in sys.argv):
     if '--verbose' in sys.argv : sys.argv.remove('--verbose')
     verbose = True
 else : verbose = False
+flush = popoption('--flush', 'immediate')
+try : session_timeout = int(popoption('--timeout', 300))
+except ValueError:
+    cprint('The session timeout must be an integer', color = 'red')
+    sys.exit(1)
+try : keypool = int(popoption('--keypool', 0))
+except ValueError:
+    cprint('The key pool size must be an integer', color = 'red')
+    sys.exit(1)
+if '--profile' in sys.argv:
+    sys.argv.remove('--profile')
+    Profiler.enabled = True
+Profiler.logfile = popoption('--profile', None)
+if Profiler.logfile is not None: Profiler.enabled = True
+durability = popoption('--durability', Giltzarrapo.DURABILITY)
+if durability not in Giltzarrapo.DURABILITY_LEVELS:
+    cprint('Unknown durability level {}. Use one of {}'.format(durability, ', '.join(Giltzarrapo.DURABILITY_LEVELS)), color = 'red')
+    sys.exit(1)
+batch = popoption('--batch', None)
+if batch is not None:
+    if not isfile(batch):
+        cprint('Batch file {} not found'.format(batch), color = 'red')
+        sys.exit(1)
+    batch = batchlines(batch)
 
 PasswdManager.verbose = verbose
-cm = CommandManager(*sys.argv[1:4])
+Giltzarrapo.DURABILITY = durability
+try : cm = CommandManager(*sys.argv[1:4], flush = flush, session_timeout = session_timeout, keypool = keypool)
+except ValueError as e:
+    cprint(str(e), color = 'red')
+    sys.exit(1)
 
-clear()
+if batch is None: clear()
 command = ""
-while command != "exit":
-    try : command = cm.im.input('passranoid>> ')
-    except KeyboardInterrupt:
-        if not cm.im.is_something_writed(): break
-        else : print('^C')
-    except : break
-    else :
-        command, args = command.split(' ')[0], command.split(' ')[1:]
+status = 0
+#Write the pending changes of the session even if a command raises
+try :
+    while command != "exit":
         try :
-            if command == 'create' :
-                create_args = cm.handle(command, args)
-                if create_args != False: PasswdManager.create(*create_args)
-            elif command == 'import':
-                import_args = cm.handle(command, args)
-                if import_args != False: PasswdManager.importdb(*import_args)
-            elif command == 'passgen' :
-                passgen_args = cm.handle(command, args)
-                if passgen_args != False:
-                    newpasswd = PasswdManager.passgen(*passgen_args)
-                    cprint('Generated password : ', color = 'blue', end = "")
-                    cprint(newpasswd, color = 'lblue')
-            elif command == 'clear' : clear()
-            elif command == 'help' : print_help()
-            elif command == 'use':
-                verify_args = cm.handle(command, args)
-                if verify_args != False:
-                    success = PasswdManager.verifyauth(*verify_args)
-                    if not success : cprint('Wrong password or/and passphrase', color = 'red')
-                    else : cm.set_auth(*verify_args)
-            elif command == 'insert' or command == 'add':
-                insert_args = cm.handle('insert', args)
-                if insert_args != False: PasswdManager.insert(*insert_args)
-            elif command == 'select':
-                select_args = cm.handle(command, args)
-                if select_args != False:
-                    query_match = PasswdManager.select(*select_args)
-                    if len(query_match) > 0: ctable(
-                        header = ['id', 'service', 'user', 'password'],
-                        data = [([i] + l.split('\t')) for i,l in query_match],
-                        header_color = 'blue', rows_color = 'lblue'
-                    )
-                    else : cprint('No matches', color = 'orange')
-            elif command == 'remove' or command == 'rm':
-                remove_args = cm.handle('remove', args)
-                if remove_args != False :
-                    success = PasswdManager.remove(*remove_args)
-                    if not success : cprint('The index does not exists', color = 'red')
-            elif command == 'list' or command == 'ls':
-                list_args = cm.handle('list', args)
-                if list_args != False:
-                    entries = PasswdManager.list(*list_args)
-                    if len(entries) > 0: ctable(
-                        header = ['id', 'service', 'user', 'password'],
-                        data = [([i] + l.split('\t')) for i,l in entries],
-                        header_color = 'blue', rows_color = 'lblue'
-                    )
-                    else : cprint('No entries', color = 'orange')
-            elif command == 'changedbpass' :
-                changedbpass_args = cm.handle(command, args)
-                if changedbpass_args != False: PasswdManager.changedbpass(*changedbpass_args)
-            elif command == 'changedbkey' :
-                changedbkey_args = cm.handle(command, args)
-                if changedbkey_args != False : PasswdManager.changedbkey(*changedbkey_args)
-            elif command == 'export' :
-                export_args = cm.handle(command, args)
-                if export_args != False:
-                    success = PasswdManager.exportdb(*export_args)
-                    if not success: cprint('The database contains no rows to export', color = 'red')
-            elif command == 'version' :
-                version_args = cm.handle(command, args)
-                if version_args != False:
-                    for vtype in PasswdManager.version(*version_args).split('\t'):
-                        cprint(vtype, color = 'lblue')
-            elif command == 'exit' : pass
-            elif command == '' : pass
-            else : cprint('Unknown command {}'.format(command), color = 'red')
-        except KeyboardInterrupt: print('^C')
-        except EOFError: print('^D')
+            if batch is None: command = cm.im.input('passranoid>> ')
+            else : lineno, command = next(batch)
+        except StopIteration: break
+        except KeyboardInterrupt:
+            if not cm.im.is_something_writed(): break
+            else : print('^C')
+        except : break
+        else :
+            command, args = command.split(' ')[0], command.split(' ')[1:]
+            #Commands that can not run inside a transaction first commit the batch commands before them
+            if batch is not None and command in CommandManager.nontransactional and cm.in_transaction():
+                if not cm.transaction('commit'): command = ''
+            Profiler.begin()
+            cm.lock_session()
+            try :
+                if command == 'create' :
+                    create_args = cm.handle(command, args)
+                    if create_args != False: PasswdManager.create(*create_args, keypool = cm.keypool)
+                elif command == 'import':
+                    import_args = cm.handle(command, args)
+                    if import_args != False:
+                        try : rows, elapsed = PasswdManager.importdb(*import_args, session = cm.session)
+                        except ValueError as e: CommandManager.error('Nothing imported. {}'.format(e))
+                        else : cprint('{} rows imported ({:.0f} rows/s)'.format(rows, rows / max(elapsed, 1e-6)), color = 'green')
+                elif command == 'passgen' :
+                    passgen_args = cm.handle(command, args)
+                    if passgen_args != False:
+                        newpasswd = PasswdManager.passgen(*passgen_args)
+                        cprint('Generated password : ', color = 'blue', end = "")
+                        cprint(newpasswd, color = 'lblue')
+                elif command == 'clear' : clear()
+                elif command == 'help' : print_help()
+                elif command == 'use':
+                    verify_args = cm.handle(command, args)
+                    if verify_args != False:
+                        session = cm.new_session(*verify_args)
+                        success = PasswdManager.verifyauth(*verify_args, session = session)
+                        if not success :
+                            if cm.check_files(verify_args[0], recheck = True): CommandManager.error('Wrong password or/and passphrase')
+                        else :
+                            cm.set_auth(*verify_args)
+                            cm.set_session(session)
+                elif command == 'insert' or command == 'add':
+                    insert_args = cm.handle('insert', args)
+                    if insert_args != False: PasswdManager.insert(*insert_args, session = cm.session)
+                elif command == 'select' and '--all' in args:
+                    select_args = cm.handle('selectall', [a for a in args if a != '--all'])
+                    if select_args != False:
+                        query_match, failed = PasswdManager.selectall(*select_args, session = cm.session)
+                        for dbname, error in failed.items(): CommandManager.error('Can not search {} : {}'.format(dbname, error))
+                        if len(query_match) > 0: ctable(
+                            header = ['database', 'id', 'service', 'user', 'password'],
+                            data = [([dbname, i] + l) for dbname,i,l in query_match],
+                            header_color = 'blue', rows_color = 'lblue'
+                        )
+                        elif len(failed) < len(select_args[0]) : cprint('No matches', color = 'orange')
+                elif command == 'select':
+                    select_args = cm.handle(command, args)
+                    if select_args != False:
+                        query_match = PasswdManager.select(*select_args, session = cm.session)
+                        if len(query_match) > 0: ctable(
+                            header = ['id', 'service', 'user', 'password'],
+                            data = [([i] + l) for i,l in query_match],
+                            header_color = 'blue', rows_color = 'lblue'
+                        )
+                        else : cprint('No matches', color = 'orange')
+                elif command == 'remove' or command == 'rm':
+                    remove_args = cm.handle('remove', args)
+                    if remove_args != False :
+                        success = PasswdManager.remove(*remove_args, session = cm.session)
+                        if success is False : CommandManager.error('The index does not exists')
+                        elif success == 0 : cprint('No matching rows', color = 'orange')
+                elif command == 'list' or command == 'ls':
+                    list_args = cm.handle('list', args)
+                    if list_args != False:
+                        entries = PasswdManager.list(*list_args, session = cm.session)
+                        if len(entries) > 0: ctable(
+                            header = ['id', 'service', 'user', 'password'],
+                            data = [([i] + l) for i,l in entries],
+                            header_color = 'blue', rows_color = 'lblue'
+                        )
+                        else : cprint('No entries', color = 'orange')
+                elif command == 'changedbpass' :
+                    changedbpass_args = cm.handle(command, args)
+                    if changedbpass_args != False: PasswdManager.changedbpass(*changedbpass_args, session = cm.session)
+                elif command == 'changedbkey' :
+                    changedbkey_args = cm.handle(command, args)
+                    if changedbkey_args != False : PasswdManager.changedbkey(*changedbkey_args, session = cm.session, keypool = cm.keypool)
+                elif command == 'export' :
+                    export_args = cm.handle(command, args)
+                    if export_args != False:
+                        success = PasswdManager.exportdb(*export_args, session = cm.session)
+                        if not success: CommandManager.error('The database contains no rows to export')
+                elif command == 'version' :
+                    version_args = cm.handle(command, args)
+                    if version_args != False:
+                        for vtype in PasswdManager.version(*version_args, session = cm.session).split('\t'):
+                            cprint(vtype, color = 'lblue')
+                elif command == 'refresh' :
+                    refresh_args = cm.handle(command, args)
+                    if refresh_args != False: PasswdManager.refresh(*refresh_args, session = cm.session)
+                elif command == 'begin' :
+                    #The whole batch already runs inside a transaction
+                    if batch is None or not cm.in_transaction(): cm.transaction('begin')
+                elif command == 'commit' : cm.transaction('commit')
+                elif command == 'rollback' : cm.transaction('rollback')
+                elif command == 'exit' : pass
+                elif command == '' : pass
+                else : CommandManager.error('Unknown command {}'.format(command))
+            except KeyboardInterrupt: print('^C')
+            except EOFError: print('^D')
+            except ValueError as e:
+                cm.config.forget()
+                CommandManager.error(str(e))
+            except Exception as e:
+                if batch is None: raise
+                CommandManager.error('{} failed : {}'.format(command, e))
+            finally : cm.unlock_session()
+            Profiler.end(command)
 
-clear()
+            if batch is not None:
+                if CommandManager.errors > 0:
+                    if cm.in_transaction(): cm.transaction('rollback')
+                    CommandManager.error('Batch aborted at line {}. The uncommitted changes were discarded'.format(lineno))
+                    status = 1
+                    break
+                if cm.session is not None and not cm.in_transaction(): cm.transaction('begin')
+
+    if batch is not None and status == 0 and cm.in_transaction():
+        if not cm.transaction('commit'): status = 1
+finally :
+    cm.close_session()
+    if cm.keypool is not None: cm.keypool.close()
+if batch is None: clear()
+sys.exit(status)
@@ -0,0 +1,48 @@
+import os
+import sys
+import yaml
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'modules'))
+from pmanager import PasswdManager
+
+class BatchTest(unittest.TestCase):
+    """Runs passranoid.py --batch with the credentials given through stdin"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp(prefix = 'passranoid-test-')
+        for d in ['db', 'keys', 'config']: os.mkdir(os.path.join(cls.dir, d))
+        PasswdManager.create('t', 'pw', 'pp', os.path.join(cls.dir, 'db'), os.path.join(cls.dir, 'keys'))
+        cls.conf = {'dbfile' : os.path.join(cls.dir, 'db', 't'), 'privkey' : os.path.join(cls.dir, 'keys', 't'), 'pubkey' : os.path.join(cls.dir, 'keys', 't.pub')}
+        cls.configfile = os.path.join(cls.dir, 'config', 'passranoid.conf')
+        with open(cls.configfile, 'w') as f: yaml.dump({'t' : cls.conf}, f)
+
+    @classmethod
+    def tearDownClass(cls): shutil.rmtree(cls.dir)
+
+    def run_batch(self, lines, answers):
+        batchfile = os.path.join(self.dir, 'batch')
+        with open(batchfile, 'w') as f: f.write('\n'.join(lines) + '\n')
+        env = dict(os.environ, PYTHONPATH = os.path.join(ROOT, 'modules'))
+        script = os.path.join(ROOT, 'script', 'passranoid.py')
+        return subprocess.run([sys.executable, script, self.configfile, os.path.join(self.dir, 'db'), os.path.join(self.dir, 'keys'), '--batch={}'.format(batchfile)],
+            input = '\n'.join(answers) + '\n', env = env, stdin = None, stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True).returncode
+
+    def test_commands_outside_transactions(self):
+        #refresh and changedbpass commit the batch commands before them instead of aborting the batch
+        status = self.run_batch(['use t', 'insert a b c', 'refresh', 'insert d e f', 'changedbpass', 'insert g h i'], ['pw', 'pp', 'newpw', 'newpw'])
+        self.assertEqual(status, 0)
+        self.assertEqual([r[0] for i,r in PasswdManager.list(self.conf, 'newpw', 'pp')], ['a', 'd', 'g'])
+
+        #A later error only rolls back the commands after the last commit
+        status = self.run_batch(['use t', 'insert j k l', 'refresh', 'insert m n o', 'remove 99'], ['newpw', 'pp'])
+        self.assertEqual(status, 1)
+        self.assertEqual([r[0] for i,r in PasswdManager.list(self.conf, 'newpw', 'pp')], ['a', 'd', 'g', 'j'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import sys
+import random
+import string
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'modules'))
+from giltzarrapo import Giltzarrapo
+
+class RankBlocksTest(unittest.TestCase):
+    """The symetric block chosen on a sample of blocks against the entropy of every block"""
+
+    #Entropy below the threshold of the full scan maximum accepted for the chosen block
+    TOLERANCE = 0.05
+
+    @classmethod
+    def setUpClass(cls):
+        #A database of 100000 rows, about 10000 blocks, far more than the sample
+        rand = random.Random(1)
+        alphabet = string.ascii_letters + string.digits + '!()?{}[]<>|@#$%&/=+*-_.:;,'
+        rows = ''.join(['service{}\tuser{}@example.com\t{}\n'.format(i, rand.randrange(1000), ''.join([rand.choice(alphabet) for _ in range(rand.randrange(8, 30))])) for i in range(100000)])
+        cls.data = rows.encode('utf-8')
+
+    def container(self, entropy_sample = None):
+        g = Giltzarrapo(entropy_sample = entropy_sample)
+        g.blocks.data = bytearray(self.data)
+        return g
+
+    def test_sampled_block_close_to_maximum(self):
+        g = self.container()
+        maximum = max([Giltzarrapo.blockEntropy(g.blocks[i]) for i in range(len(g.blocks))])
+        self.assertGreater(len(g.blocks), Giltzarrapo.ENTROPY_SAMPLE)
+
+        for sample in [None, Giltzarrapo.ENTROPY_SAMPLE_PURE]:
+            g = self.container(sample)
+            for _ in range(20):
+                entropy = Giltzarrapo.blockEntropy(g.blocks[g.selectBlock()])
+                self.assertGreaterEqual(entropy, maximum * (Giltzarrapo.ENTROPY_THRESHOLD - RankBlocksTest.TOLERANCE))
+
+    def test_sample_size(self):
+        self.assertEqual(len(self.container(64).rankBlocks()), 64)
+        self.assertEqual(len(self.container(10 ** 6).rankBlocks()), len(self.container().blocks))
+        with self.assertRaises(ValueError): Giltzarrapo(entropy_sample = 0)
+
+if __name__ == '__main__':
+    unittest.main()